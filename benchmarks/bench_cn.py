@@ -0,0 +1,144 @@
+""" Times each stage of the congestion number pipeline on a synthetic study and saves the results as JSON
+
+    python benchmarks/bench_cn.py --x-size 300 --y-size 300 --pedestrians 500 --output bench.json
+
+Each stage is timed --repeat times on a fresh GridCollection, the best and all timings are kept. A last
+run under tracemalloc gives the peak memory allocated during each stage (before Python 3.9, only the net
+memory change of the stage, tracemalloc.reset_peak being missing).
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+import pedtools
+from pedtools.metrics.crowd.congestion_number.congestion_number import GridCollection, Params, Statistics
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from generate import generate  # noqa: E402
+
+
+def pipeline(study, out_dir, text_fields=False):
+    """ Stages of a congestion_number run as (name, callable), to be called in order """
+    params = Params(os.path.join(study, 'parameters'))
+    cn_radius = params.params['cn_radius']
+    state = {}
+
+    def init_velocity_field():
+        state['gc'] = GridCollection(*params.grid_args())
+        with contextlib.redirect_stdout(io.StringIO()):  # ignored pedestrians
+            state['gc'].init_velocity_field(os.path.join(study, 'positions'))
+
+    def calc_statistics():
+        state['stats'] = Statistics(state['gc'])
+        state['stats'].calc_statistics()
+
+    stages = [
+        ('init_velocity_field', init_velocity_field),
+        ('scale_velocity_field', lambda: state['gc'].scale_velocity_field()),
+        ('calc_rotor', lambda: state['gc'].calc_rotor()),
+        ('calc_cn', lambda: state['gc'].calc_cn(cn_radius)),
+        ('calc_statistics', calc_statistics),
+        ('write_statistics', lambda: state['stats'].write_to_files(out_dir)),
+        ('write_fields', lambda: state['gc'].write_fields(os.path.join(out_dir, 'fields.npz'))),
+    ]
+    if text_fields:  # one text file per grid and field under data/ of the working directory
+        stages += [('write_velocity', lambda: state['gc'].write_velocity()),
+                   ('write_rotor', lambda: state['gc'].write_rotor()),
+                   ('write_cn', lambda: state['gc'].write_cn())]
+    return stages
+
+
+def run(study, out_dir, repeat=3, text_fields=False):
+    timings = {}
+    for _ in range(repeat):
+        for name, stage in pipeline(study, out_dir, text_fields):
+            start = time.perf_counter()
+            stage()
+            timings.setdefault(name, []).append(time.perf_counter() - start)
+    peaks = {}
+    peak = 0  # of the whole run
+    tracemalloc.start()
+    try:
+        for name, stage in pipeline(study, out_dir, text_fields):
+            if hasattr(tracemalloc, 'reset_peak'):  # Python >= 3.9
+                tracemalloc.reset_peak()
+            before = tracemalloc.get_traced_memory()[0]
+            stage()
+            current, stage_peak = tracemalloc.get_traced_memory()
+            if not hasattr(tracemalloc, 'reset_peak'):  # only the memory at the start and end is known
+                stage_peak = max(before, current)
+            peaks[name] = stage_peak - before
+            peak = max(peak, stage_peak)
+    finally:
+        tracemalloc.stop()
+    return {name: {'best_s': min(times), 'times_s': times, 'peak_bytes': peaks[name]}
+            for name, times in timings.items()}, peak
+
+
+def _git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--repetitions', type=int, default=2)
+    parser.add_argument('--timesteps', type=int, default=10)
+    parser.add_argument('--x-size', type=int, default=100)
+    parser.add_argument('--y-size', type=int, default=100)
+    parser.add_argument('--pedestrians', type=int, default=200)
+    parser.add_argument('--fps', type=int, default=10)
+    parser.add_argument('--cn-radius', type=float, default=3.5)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=3, help='Timed runs of each stage')
+    parser.add_argument('--text-fields', action='store_true', help='Also time the per-grid text writers')
+    parser.add_argument('--output', default=None, help='JSON file the results are written to, stdout by default')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        study = os.path.join(work_dir, 'study')
+        config = generate(study, args.repetitions, args.timesteps, args.x_size, args.y_size, args.pedestrians,
+                          args.fps, cn_radius=args.cn_radius, seed=args.seed)
+        config.update(pedestrians=args.pedestrians, fps=args.fps, seed=args.seed, repeat=args.repeat)
+        out_dir = os.path.join(work_dir, 'out')
+        os.makedirs(os.path.join(out_dir, 'data'))
+        cwd = os.getcwd()
+        os.chdir(out_dir)
+        try:
+            stages, peak = run(study, out_dir, args.repeat, args.text_fields)
+        finally:
+            os.chdir(cwd)
+
+    result = {
+        'version': {'pedtools': pedtools.__version__, 'git': _git_revision(), 'numpy': np.__version__,
+                    'python': platform.python_version(), 'platform': platform.platform()},
+        'config': config,
+        'stages': stages,
+        'total_best_s': sum(stage['best_s'] for stage in stages.values()),
+        'peak_bytes': peak,
+    }
+    if args.output:
+        with open(args.output, 'w') as fp:
+            json.dump(result, fp, indent=2)
+    else:
+        json.dump(result, sys.stdout, indent=2)
+        sys.stdout.write('\n')
+    for name, stage in stages.items():
+        print(f"{name:>22} {stage['best_s']:10.4f} s {stage['peak_bytes'] / 2 ** 20:10.1f} MB", file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,54 @@
+""" Synthetic study for the congestion number benchmarks: a parameters file and positions/pos_{rep}.dat
+
+    python benchmarks/generate.py DIR --x-size 300 --y-size 300 --pedestrians 500
+"""
+import argparse
+import os
+
+import numpy as np
+
+
+def generate(directory, num_repetitions=2, num_timesteps=10, x_size=100, y_size=100, pedestrians=200, fps=10,
+             delta_x=0.5, delta_t=1.0, cn_radius=3.5, seed=0):
+    """ Writes a study of pedestrians walking with a random drift over the grid, reproducible for a given seed """
+    rng = np.random.default_rng(seed)
+    width = x_size * delta_x
+    height = y_size * delta_x
+    params = {'num_repetitions': num_repetitions, 'num_timesteps': num_timesteps, 'x_size': x_size,
+              'y_size': y_size, 'delta_x': delta_x, 'delta_y': delta_x, 'x_min': 0, 'y_min': 0,
+              'delta_t': delta_t, 'cn_radius': cn_radius}
+    os.makedirs(os.path.join(directory, 'positions'), exist_ok=True)
+    with open(os.path.join(directory, 'parameters'), 'w') as fp:
+        for key, value in params.items():
+            fp.write(f'{key} {value}\n')
+    num_frames = int(num_timesteps * delta_t * fps)
+    for rep_idx in range(num_repetitions):
+        pos = rng.uniform((0, 0), (width, height), (pedestrians, 2))
+        vel = rng.normal((1.0, 0.2), 0.3, (pedestrians, 2))
+        with open(os.path.join(directory, 'positions', f'pos_{rep_idx}.dat'), 'w') as fp:
+            for frame in range(num_frames):
+                fp.write(f'{frame / fps} {pedestrians}\n')
+                fp.write(' '.join(f'{v:.4f}' for v in np.hstack((pos, vel)).ravel().tolist()) + '\n')
+                vel += rng.normal(0, 0.05, vel.shape)
+                pos = (pos + vel / fps) % (width, height)  # walking out of a side enters from the other
+    return params
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('directory')
+    parser.add_argument('--repetitions', type=int, default=2)
+    parser.add_argument('--timesteps', type=int, default=10)
+    parser.add_argument('--x-size', type=int, default=100)
+    parser.add_argument('--y-size', type=int, default=100)
+    parser.add_argument('--pedestrians', type=int, default=200)
+    parser.add_argument('--fps', type=int, default=10)
+    parser.add_argument('--cn-radius', type=float, default=3.5)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    generate(args.directory, args.repetitions, args.timesteps, args.x_size, args.y_size, args.pedestrians, args.fps,
+             cn_radius=args.cn_radius, seed=args.seed)
+
+
+if __name__ == '__main__':
+    main()
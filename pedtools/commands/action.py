@@ -1,6 +1,9 @@
 import argparse
 import abc
-from typing import List, Any, Optional, Dict
+import contextlib
+import time
+import tracemalloc
+from typing import List, Any, Optional, Dict, Iterator
 from pedtools.commands.hookspecs import PedtoolsPlugin
 
 
@@ -38,6 +41,7 @@ class PedtoolsAction(metaclass=abc.ABCMeta):
 
     def __init__(self) -> None:
         self._hook: Optional[PedtoolsPlugin] = None
+        self._stage_hooks = False
 
     @non_runnable
     def action(self, config: dict):  # needs to be implemented in the child objects, else
@@ -57,7 +61,11 @@ class PedtoolsAction(metaclass=abc.ABCMeta):
         # define common shared arguments
         base_subparser = argparse.ArgumentParser(add_help=False)
         base_subparser.add_argument(
-            '--cite', action=store_true, help='Print citable reference for this module')
+            '--cite', action='store_true', help='Print citable reference for this module')
+        base_subparser.add_argument(
+            '--profile', default=None, help='Write the timings of each stage of the action to this file')
+        base_subparser.add_argument(
+            '--profile-format', default='json', choices=['json', 'prometheus'], help='Format of the --profile file')
         additional_parsers = self.action_flags()
         additional_parsers.append(base_subparser)
         return additional_parsers
@@ -73,24 +81,65 @@ class PedtoolsAction(metaclass=abc.ABCMeta):
 
     def add_hook(self, hook: PedtoolsPlugin) -> None:
         self._hook = hook
+        self._stage_hooks = bool(hook.pedtools_pre_stage.get_hookimpls() or  # type: ignore
+                                 hook.pedtools_post_stage.get_hookimpls())  # type: ignore
+
+    @contextlib.contextmanager
+    def _run_stage(self, config: dict, name: str) -> Iterator[dict]:
+        self._hook.pedtools_pre_stage(config=config, stage=name)  # type: ignore
+        record = {'items': 0}
+        memory = tracemalloc.get_traced_memory()[0] if tracemalloc.is_tracing() else None
+        start = time.perf_counter()
+        try:
+            yield record
+        finally:  # a failing stage is reported too
+            elapsed = time.perf_counter() - start
+            if memory is not None and tracemalloc.is_tracing():
+                memory = tracemalloc.get_traced_memory()[0] - memory
+            self._hook.pedtools_post_stage(config=config, stage=name, elapsed=elapsed,  # type: ignore
+                                           items=int(record['items']), memory_delta=memory)
+
+    def stage(self, config: dict, name: str):
+        """ Context manager around a stage of the action, firing the pre/post stage hooks
+
+            Yields a dict whose 'items' the stage can set to the number of items it processed. Without
+            stage hooks registered it does nothing.
+        """
+        if not self._stage_hooks:
+            return contextlib.nullcontext({'items': 0})
+        return self._run_stage(config, name)
+
+    def report_stage(self, config: dict, name: str, elapsed: float, items: int = 0) -> None:
+        """ Fires the pre/post stage hooks for a stage the action timed itself, e.g. summed over many bins
+
+            Its memory is not measured, memory_delta is None.
+        """
+        if not self._stage_hooks:
+            return
+        self._hook.pedtools_pre_stage(config=config, stage=name)  # type: ignore
+        self._hook.pedtools_post_stage(config=config, stage=name, elapsed=elapsed,  # type: ignore
+                                       items=int(items), memory_delta=None)
 
     def run_action(self, config: dict):
 
         config = self.pre_action(config)
-        self.action(config)
-        self.post_action(config)
+        try:
+            self.action(config)
+        finally:  # e.g. writes the profiling report of a failed run
+            self.post_action(config)
 
     def pre_action(self, config: dict) -> dict:
         if self._hook:
-            configs = self._hook.pedtoolsclient_add_pre_action(
+            configs = self._hook.pedtools_add_pre_action(
                 config=config)
-            final_config = {}
-            for c in configs:
-                final_config.update(c)
+            if configs:
+                final_config = {}
+                for c in configs:
+                    final_config.update(c)
                 return final_config
         return config
 
     def post_action(self, config: dict):
         if self._hook:
-            self._hook.pedtoolsclient_add_post_action(
+            self._hook.pedtools_add_post_action(
                 config=config)
@@ -3,7 +3,8 @@ from typing import List, TypeVar, Callable, Any, Dict, cast, Optional
 
 """ Hook Specifications
         Pre hook executed before the main action
-        Post hook executed after the main action
+        Post hook executed after the main action, even if it failed
+        Pre and post stage hooks executed around each stage of the action (e.g. ingest, cn, write)
 """
 
 # Typed as per: https://stackoverflow.com/questions/54674679/how-can-i-annotate-types-for-a-pluggy-hook-specification
@@ -26,8 +27,34 @@ class PedtoolsPlugin:
     @staticmethod
     @hookspec
     def pedtools_add_post_action(config: dict):
-        """ Hook running after the action
+        """ Hook running after the action, also when the action raised
 
         :param config: dictionary of parsed configuration used used by the action
         :return: No return value
         """
+
+    @staticmethod
+    @hookspec
+    def pedtools_pre_stage(config: dict, stage: str):
+        """ Hook running before a stage of the action
+
+        :param config: dictionary of parsed configuration used by the action
+        :param stage: name of the stage, e.g. ingest, scale, rotor, cn, statistics, write
+        :return: No return value
+        """
+
+    @staticmethod
+    @hookspec
+    def pedtools_post_stage(config: dict, stage: str, elapsed: float, items: int, memory_delta: Optional[int]):
+        """ Hook running after a stage of the action, also when the stage raised
+
+        :param config: dictionary of parsed configuration used by the action
+        :param stage: name of the stage
+        :param elapsed: wall time of the stage in seconds
+        :param items: number of items the stage processed (frames, grids, files...), 0 if not counted
+        :param memory_delta: change of the memory traced by tracemalloc in bytes, None when not tracing or
+            not measured (a stage timed by the action itself, see PedtoolsAction.report_stage).
+            Tracing is started by the built-in profiling plugin (--profile); other plugins wanting it without
+            --profile start tracemalloc themselves in pedtools_add_pre_action
+        :return: No return value
+        """
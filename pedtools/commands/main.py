@@ -1,17 +1,127 @@
 import pluggy  # type: ignore
 import os
 import argparse
+import glob
+import importlib
+import importlib.metadata
+import json
+import tempfile
 import textwrap
 import sys
-import yaml
 
 from pedtools.commands.hookspecs import PedtoolsPlugin
 from pedtools.commands.action import PedtoolsAction
-
-from pkg_resources import working_set
+from pedtools.commands.profiling import ProfilingPlugin
 
 from typing import Any, Sequence, Dict, Optional, Union, List, Callable, Tuple
 
+ENTRY_POINTS_CACHE_VERSION = 2
+
+
+def _entry_points_cache_file() -> str:
+    cache_dir = os.environ.get('PEDTOOLS_CACHE_DIR') or os.path.join(
+        os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache'), 'pedtools')
+    return os.path.join(cache_dir, 'entry_points.json')
+
+
+def _entry_points_files() -> List[str]:
+    """The entry_points.txt of the *.dist-info and *.egg-info distributions on sys.path, in sys.path order"""
+    fnames = []
+    for path in sys.path:
+        for pattern in ('*.dist-info', '*.egg-info'):
+            fnames.extend(sorted(glob.glob(os.path.join(os.path.abspath(path), pattern, 'entry_points.txt'))))
+    return fnames
+
+
+def _distributions_fingerprint(fnames: Sequence[str]) -> list:
+    """Changes whenever a distribution is installed or removed, or one of fnames is rewritten
+
+        Installing or removing a distribution changes the modification time of its sys.path entry, sys.path[0]
+        (the directory of the script or the working directory) included. A develop install (pip install -e)
+        rewrites the entry_points.txt of its egg-info in place, so the modification time and size of the
+        entry_points.txt files providing pedtools entry points, fnames, are part of the fingerprint too.
+    """
+    fingerprint: list = [ENTRY_POINTS_CACHE_VERSION, sys.version]
+    for path in sys.path:
+        try:
+            fingerprint.append([os.path.abspath(path), os.stat(path or '.').st_mtime_ns])
+        except OSError:
+            continue
+    for fname in fnames:
+        try:
+            stat = os.stat(fname)
+            fingerprint.append([fname, stat.st_mtime_ns, stat.st_size])
+        except OSError:
+            fingerprint.append([fname, None])
+    return fingerprint
+
+
+def _discover_entry_points() -> Tuple[Dict[str, Dict[str, str]], List[str]]:
+    """The pedtools entry points and the entry_points.txt files providing them"""
+    entry_points: Dict[str, Dict[str, str]] = {}
+    fnames = []
+    for fname in _entry_points_files():
+        provides = False
+        for entry_point in importlib.metadata.Distribution.at(os.path.dirname(fname)).entry_points:
+            if entry_point.group == 'pedtools' or entry_point.group.startswith('pedtools.'):
+                # first distribution on sys.path wins, as for imports
+                entry_points.setdefault(entry_point.group, {}).setdefault(entry_point.name, entry_point.value)
+                provides = True
+        if provides:
+            fnames.append(fname)
+    return entry_points, fnames
+
+
+def get_entry_points() -> Dict[str, Dict[str, str]]:
+    """All the pedtools entry points as {group: {name: 'module:attr'}}
+
+        Scanning the installed distributions is slow with many packages installed, so the result is cached
+        on disk (PEDTOOLS_CACHE_DIR, by default ~/.cache/pedtools) with the entry_points.txt files it came
+        from, until a distribution changes (see _distributions_fingerprint).
+    """
+    fname = _entry_points_cache_file()
+    try:
+        with open(fname) as fp:
+            cached = json.load(fp)
+        if cached['fingerprint'] == _distributions_fingerprint(cached['files']):
+            return cached['entry_points']
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+    entry_points, files = _discover_entry_points()
+    try:
+        os.makedirs(os.path.dirname(fname), exist_ok=True)
+        fd, tmp_fname = tempfile.mkstemp(dir=os.path.dirname(fname), suffix='.tmp')
+        with os.fdopen(fd, 'w') as fp:
+            json.dump({'fingerprint': _distributions_fingerprint(files), 'files': files,
+                       'entry_points': entry_points}, fp)
+        os.replace(tmp_fname, fname)
+    except OSError:  # e.g. read only home, works without the cache
+        pass
+    return entry_points
+
+
+def _load_entry_point(value: str) -> Any:
+    module, _, attr = value.partition(':')
+    obj = importlib.import_module(module.strip())
+    for name in attr.strip().split('.') if attr.strip() else []:
+        obj = getattr(obj, name)
+    return obj
+
+
+def _commands(entry_points: Dict[str, Dict[str, str]], namespace: str) -> Dict[str, str]:
+    return {name: value for name, value in entry_points.get(namespace, {}).items() if "hook" not in name}
+
+
+def requested_path(argv: Sequence[str], entry_points: Dict[str, Dict[str, str]], namespace: str = 'pedtools') -> List[str]:
+    """Leading command names of argv, e.g. ['crowd', 'congestion_number'], stopping at the first other token"""
+    path = []
+    for token in argv:
+        if token not in _commands(entry_points, namespace):
+            break
+        path.append(token)
+        namespace += "." + token
+    return path
+
 
 def _get_parser() -> argparse.ArgumentParser:
     # LV0/Base Parser
@@ -23,40 +133,56 @@ def _get_parser() -> argparse.ArgumentParser:
     return lv0_parser
 
 
-def init_parser(parser: argparse.ArgumentParser, namespace: str, group_description: str = 'Available Commands') -> None:
-    if len(list(working_set.iter_entry_points(namespace))):
-        subparser = parser.add_subparsers(help=group_description)
-    for entry_point in working_set.iter_entry_points(namespace):
-        if "hook" not in entry_point.name:
-            # load can raise exception due to missing imports or error in
-            # object creation
-            subcommand = entry_point.load()
-            command_parser = subparser.add_parser(
-                entry_point.name,
-                help=subcommand.help_description(),
-                parents=subcommand.register_subparsers())
-            action = None
-            if not getattr(subcommand.action, '__isnotrunnable__', False):
-                action = getattr(subcommand, "action", None)
-            if callable(action):
-                command_parser.set_defaults(
-                    action=subcommand,
-                    help=command_parser.print_help,
-                    namespace=namespace + "." + entry_point.name)
-            else:
-                command_parser.set_defaults(
-                    help=command_parser.print_help,
-                    namespace=namespace + "." + entry_point.name)
-
-            group_description = subcommand.group_description()
-            if group_description:
-                init_parser(command_parser, namespace + "." +
-                            entry_point.name, group_description)
-            else:
-                init_parser(command_parser, namespace + "." + entry_point.name)
+def init_parser(parser: argparse.ArgumentParser, namespace: str, group_description: str = 'Available Commands',
+                path: Optional[Sequence[str]] = None, entry_points: Optional[Dict[str, Dict[str, str]]] = None) -> None:
+    """Adds the commands of namespace to parser
+
+        With path (the requested command names, see requested_path) only the commands on it are loaded, the
+        others are listed by name, and the children of the last one are loaded for its help. Without path the
+        whole tree is loaded.
+    """
+    entry_points = get_entry_points() if entry_points is None else entry_points
+    commands = _commands(entry_points, namespace)
+    if not commands:
+        return
+    subparser = parser.add_subparsers(help=group_description)
+    requested = path[0] if path else None
+    for name, value in commands.items():
+        if requested is not None and name != requested:
+            subparser.add_parser(name)  # not loaded
+            continue
+        # load can raise exception due to missing imports or error in
+        # object creation
+        subcommand = _load_entry_point(value)
+        command_parser = subparser.add_parser(
+            name,
+            help=subcommand.help_description(),
+            parents=subcommand.register_subparsers())
+        action = None
+        if not getattr(subcommand.action, '__isnotrunnable__', False):
+            action = getattr(subcommand, "action", None)
+        if callable(action):
+            command_parser.set_defaults(
+                action=subcommand,
+                help=command_parser.print_help,
+                namespace=namespace + "." + name)
+        else:
+            command_parser.set_defaults(
+                help=command_parser.print_help,
+                namespace=namespace + "." + name)
+
+        if path is not None and requested is None:
+            continue  # listed for the help of the requested command, not descended into
+        sub_path = None if path is None else path[1:]
+        group_description = subcommand.group_description()
+        if group_description:
+            init_parser(command_parser, namespace + "." + name, group_description, sub_path, entry_points)
+        else:
+            init_parser(command_parser, namespace + "." + name, path=sub_path, entry_points=entry_points)
 
 
 def get_plugin_manager(namespace: str) -> pluggy.PluginManager:
+    entry_points = get_entry_points()
     pm = pluggy.PluginManager("pedtools")
     pm.add_hookspecs(PedtoolsPlugin)
     namespace_list = namespace.split(".")
@@ -64,8 +190,10 @@ def get_plugin_manager(namespace: str) -> pluggy.PluginManager:
     current_namespace = ""
     for space in namespace_list:
         current_namespace += space + "."
-        pm.load_setuptools_entrypoints(current_namespace + "hook.tree")
-    pm.load_setuptools_entrypoints(current_namespace + "hook")
+        if current_namespace + "hook.tree" in entry_points:  # skips scanning the distributions for nothing
+            pm.load_setuptools_entrypoints(current_namespace + "hook.tree")
+    if current_namespace + "hook" in entry_points:
+        pm.load_setuptools_entrypoints(current_namespace + "hook")
     plugin_list = pm.list_name_plugin()
     if len(plugin_list):
         print("Running using the following plugins:",
@@ -115,6 +243,7 @@ def _get_pedtools_config_file(fname: str, namespace: str) -> dict:
 
     """
     namespace = namespace.split(".")
+    import yaml  # only needed with a config file
     with open(fname) as file:
         pedtools_config_file = yaml.load(file, Loader=yaml.SafeLoader)
         pedtools_config_full_dict = dict((k.replace('-', '_'), v)
@@ -163,17 +292,20 @@ def _extract_setup(raw_config: dict, namespace) -> dict:
     return config
 
 
-def run_action(self, config: dict, action: PedtoolsAction, namespace):
+def run_action(config: dict, action: PedtoolsAction, namespace):
     # Add Hooks
     if namespace:
         pm = get_plugin_manager(namespace)
+        if config.get('profile'):
+            pm.register(ProfilingPlugin(config['profile'], config.get('profile_format') or 'json'), 'profiling')
         action.add_hook(pm.hook)
     action.run_action(config)
 
 
 def main() -> None:
     lv0_parser: argparse.ArgumentParser = _get_parser()
-    init_parser(lv0_parser, 'pedtools')
+    entry_points = get_entry_points()
+    init_parser(lv0_parser, 'pedtools', path=requested_path(sys.argv[1:], entry_points), entry_points=entry_points)
 
     args = lv0_parser.parse_args()
 
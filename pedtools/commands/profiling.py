@@ -0,0 +1,85 @@
+import json
+import tracemalloc
+from typing import List, Optional, Callable, Any, TypeVar, cast
+
+import pluggy  # type: ignore
+
+F = TypeVar("F", bound=Callable[..., Any])
+hookimpl = cast(Callable[[F], F], pluggy.HookimplMarker("pedtools"))
+
+
+class ProfilingPlugin:
+    """ Built-in plugin recording the stage hooks and writing them to fname after the action, even a failed one
+
+        Registered by the --profile flag. Memory is traced with tracemalloc from the start of the
+        action, so the report holds the traced memory delta and peak of each stage. Before Python 3.9,
+        which lacks tracemalloc.reset_peak, the peak is the larger of the traced memory at the start and
+        end of the stage. Stages reported without a memory_delta have no peak either. fmt is 'json' or
+        'prometheus' (text exposition format).
+    """
+
+    def __init__(self, fname: str, fmt: str = 'json') -> None:
+        self.fname = fname
+        self.fmt = fmt
+        self.stages: List[dict] = []
+        self._started_tracing = False
+        self._stage_memory = 0  # traced memory at the start of the current stage
+
+    @hookimpl
+    def pedtools_add_pre_action(self, config: dict) -> dict:
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracing = True
+        return config
+
+    @hookimpl
+    def pedtools_pre_stage(self, config: dict, stage: str):
+        if hasattr(tracemalloc, 'reset_peak'):  # Python >= 3.9
+            tracemalloc.reset_peak()
+        self._stage_memory = tracemalloc.get_traced_memory()[0]
+
+    @hookimpl
+    def pedtools_post_stage(self, config: dict, stage: str, elapsed: float, items: int, memory_delta: Optional[int]):
+        memory_peak = None
+        if tracemalloc.is_tracing() and memory_delta is not None:
+            current, memory_peak = tracemalloc.get_traced_memory()
+            if not hasattr(tracemalloc, 'reset_peak'):
+                memory_peak = max(self._stage_memory, current)
+        self.stages.append({'stage': stage, 'elapsed': elapsed, 'items': items, 'memory_delta': memory_delta,
+                            'memory_peak': memory_peak})
+
+    @hookimpl
+    def pedtools_add_post_action(self, config: dict):
+        command = config.get('namespace') or ''
+        try:
+            with open(self.fname, 'w') as fp:
+                if self.fmt == 'prometheus':
+                    fp.write(self.prometheus(command))
+                else:
+                    json.dump({'command': command, 'stages': self.stages}, fp, indent=2)
+        finally:
+            if self._started_tracing:
+                tracemalloc.stop()
+                self._started_tracing = False
+
+    def prometheus(self, command: str) -> str:
+        metrics = [('elapsed', 'pedtools_stage_seconds', 'Wall time of the stage'),
+                   ('items', 'pedtools_stage_items', 'Items processed by the stage'),
+                   ('memory_delta', 'pedtools_stage_memory_delta_bytes', 'Change of the traced memory'),
+                   ('memory_peak', 'pedtools_stage_memory_peak_bytes', 'Peak traced memory during the stage')]
+        totals: dict = {}  # a stage run several times is reported once, summed (peak: max)
+        for stage in self.stages:
+            total = totals.setdefault(stage['stage'], dict.fromkeys(stage))
+            for key, value in stage.items():
+                if key == 'stage' or value is None:
+                    continue
+                total[key] = value if total[key] is None else (
+                    max(total[key], value) if key == 'memory_peak' else total[key] + value)
+        lines = []
+        for key, metric, description in metrics:
+            lines.append(f'# HELP {metric} {description}')
+            lines.append(f'# TYPE {metric} gauge')
+            for name, total in totals.items():
+                if total[key] is not None:
+                    lines.append(f'{metric}{{command="{command}",stage="{name}"}} {total[key]}')
+        return '\n'.join(lines) + '\n'
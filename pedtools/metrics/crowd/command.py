@@ -0,0 +1,16 @@
+from typing import Optional
+
+from pedtools.commands.action import PedtoolsAction
+
+
+class CrowdCommand(PedtoolsAction):
+    """ Group of the crowd metrics, e.g. pedtools crowd congestion_number """
+
+    def help_description(self) -> Optional[str]:
+        return "Crowd metrics"
+
+    def group_description(self) -> Optional[str]:
+        return "Available crowd metrics"
+
+
+crowd = CrowdCommand()
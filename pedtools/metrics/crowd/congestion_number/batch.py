@@ -0,0 +1,106 @@
+import concurrent.futures
+import json
+import os
+import time
+
+from pedtools.commands.main import _get_pedtools_config_file
+from pedtools.metrics.crowd.congestion_number.cache import FieldCache, init_fields
+from pedtools.metrics.crowd.congestion_number.congestion_number import (GridCollection, Params, Statistics,
+                                                                        StreamingGridCollection)
+
+NAMESPACE = 'pedtools.crowd.congestion_number'
+DATASET_KEYS = ('name', 'path', 'parameters', 'positions', 'output', 'cn_radius', 'streaming', 'tile')
+
+
+def load_manifest(fname):
+    """ Datasets of a batch manifest, each a dict of DATASET_KEYS, and the batch level settings
+
+        The manifest is read like a config file (see _get_pedtools_config_file): top level keys and those
+        under pedtools: crowd: congestion_number: are defaults for every dataset, and datasets is the list
+        of datasets. path is the directory holding the parameters file and the positions directory, relative
+        paths are relative to the manifest.
+    """
+    config = _get_pedtools_config_file(fname, NAMESPACE)
+    entries = config.pop('datasets', None)
+    if not isinstance(entries, list) or not entries:
+        raise ValueError(f"{fname}: expected a non empty datasets list")
+    base_dir = os.path.dirname(os.path.abspath(fname))
+    defaults = {key: value for key, value in config.items() if key in DATASET_KEYS}
+    settings = {key: value for key, value in config.items() if key not in DATASET_KEYS}
+    datasets = []
+    for idx, entry in enumerate(entries):
+        if isinstance(entry, str):
+            entry = {'path': entry}
+        unknown = set(entry) - set(DATASET_KEYS)
+        if unknown:
+            raise ValueError(f"{fname}: unknown keys {sorted(unknown)} in dataset {idx}")
+        dataset = dict(defaults, **entry)
+        path = os.path.join(base_dir, dataset.get('path') or '.')
+        dataset.setdefault('name', dataset.get('path') or str(idx))
+        dataset['parameters'] = os.path.join(path, dataset.get('parameters') or 'parameters')
+        dataset['positions'] = os.path.join(path, dataset.get('positions') or 'positions')
+        if dataset.get('output'):
+            dataset['output'] = os.path.join(base_dir, dataset['output'])
+        datasets.append(dataset)
+    return datasets, settings
+
+
+def run_dataset(dataset, cache_dir=None, cache_size=1 << 30):
+    """ Statistics of one manifest dataset, written to its output directory if any, as a results entry """
+    start = time.perf_counter()
+    params = Params(dataset['parameters'])
+    cn_radius = dataset.get('cn_radius')
+    if cn_radius is None:
+        if 'cn_radius' not in params.params:
+            raise ValueError(f"{dataset['name']}: cn_radius is neither in the parameters file nor in the manifest")
+        cn_radius = params.params['cn_radius']
+    cached = False
+    if dataset.get('streaming') or dataset.get('tile'):
+        stats = StreamingGridCollection(*params.grid_args(), tile=dataset.get('tile')).run(
+            cn_radius, dataset['positions'])
+    else:
+        gc = GridCollection(*params.grid_args())
+        cache = FieldCache(cache_dir, max_bytes=cache_size) if cache_dir else None
+        cached = init_fields(gc, dataset['positions'], cache)
+        gc.calc_cn(cn_radius)
+        stats = Statistics(gc)
+        stats.calc_statistics()
+    if dataset.get('output'):
+        os.makedirs(dataset['output'], exist_ok=True)
+        stats.write_to_files(dataset['output'])
+    return dict(dataset, cn_radius=cn_radius, cached=cached, elapsed=time.perf_counter() - start,
+                statistics=stats.to_dict())
+
+
+def _run_dataset_safe(dataset, cache_dir, cache_size):  # one failing dataset does not stop the batch
+    try:
+        return run_dataset(dataset, cache_dir, cache_size)
+    except Exception as e:
+        return dict(dataset, error=f"{type(e).__name__}: {e}")
+
+
+def run_batch(fname, results=None, workers=None, cache_dir=None, cache_size=None):
+    """ Runs every dataset of the manifest fname in this process, or in one shared pool of workers processes
+
+        The datasets share the field cache cache_dir, so a dataset listed again with another cn_radius only
+        recomputes the CN. All the statistics go to the results JSON file, returns its content.
+        results, workers, cache and cache_size (in MB) can also be set in the manifest, which applies where
+        the arguments are None, as config files do under flags. The defaults are batch_results.json, a
+        single process, no cache and 1024 MB.
+    """
+    datasets, settings = load_manifest(fname)
+    results = results or settings.get('results') or 'batch_results.json'
+    workers = int(workers or settings.get('workers') or 1)
+    cache_dir = cache_dir or settings.get('cache')
+    if cache_size is None:
+        cache_size = float(settings.get('cache_size') or 1024) * 2 ** 20
+    if workers > 1:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+            entries = list(pool.map(_run_dataset_safe, datasets, [cache_dir] * len(datasets),
+                                    [cache_size] * len(datasets)))
+    else:
+        entries = [_run_dataset_safe(dataset, cache_dir, cache_size) for dataset in datasets]
+    content = {'manifest': os.path.abspath(fname), 'results': os.path.abspath(results), 'datasets': entries}
+    with open(results, 'w') as fp:
+        json.dump(content, fp, indent=2)
+    return content
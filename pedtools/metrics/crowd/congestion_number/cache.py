@@ -0,0 +1,120 @@
+import contextlib
+import hashlib
+import json
+import os
+import tempfile
+
+import numpy as np
+
+from pedtools.metrics.crowd.congestion_number.positions import positions_files
+
+CACHE_VERSION = 2  # bump when the cached fields change meaning
+
+
+class FieldCache:
+    """ Content-addressed store of the cn_radius independent fields of a study
+
+        An entry holds the scaled velocity and density, the rotor and in_area of a GridCollection, as
+        left by init_velocity_field, scale_velocity_field and calc_rotor. Entries are keyed by the
+        sha256 of the positions files and of the grid parameters, so a radius sweep over the same data
+        only recomputes calc_cn. The directory is kept below max_bytes by evicting the least recently
+        used entries. Several processes can share the directory, e.g. the workers of a batch.
+    """
+    FIELDS = ('vx', 'vy', 'dens', 'rot', 'rotval', 'update_count')
+
+    def __init__(self, directory, max_bytes=1 << 30):
+        self.directory = directory
+        self.max_bytes = int(max_bytes)
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def key(fnames, geometry):
+        digest = hashlib.sha256(json.dumps([CACHE_VERSION, geometry], sort_keys=True).encode())
+        for fname in fnames:
+            with open(fname, 'rb') as fp:
+                file_digest = hashlib.sha256()
+                for chunk in iter(lambda: fp.read(1 << 20), b''):
+                    file_digest.update(chunk)
+            digest.update(file_digest.digest())
+        return digest.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, f'{key}.npz')
+
+    def load(self, key, gc):
+        """ Fills gc from the entry key, returns False on a cache miss """
+        path = self._path(key)
+        try:
+            with np.load(path) as data:
+                for name in self.FIELDS:
+                    getattr(gc, name)[...] = data[name]
+                gc.in_area.cell_list[...] = data['in_area']
+        except FileNotFoundError:
+            return False
+        try:
+            os.utime(path)  # most recently used
+        except FileNotFoundError:  # evicted meanwhile by another process, the fields are loaded all the same
+            pass
+        return True
+
+    def store(self, key, gc):
+        fields = {name: getattr(gc, name) for name in self.FIELDS}
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as fp:
+            np.savez(fp, in_area=gc.in_area.cell_list, **fields)
+        os.replace(tmp_path, self._path(key))
+        self.evict()
+
+    def evict(self):
+        entries = []
+        for fname in os.listdir(self.directory):
+            if fname.endswith('.npz'):
+                try:
+                    stat = os.stat(os.path.join(self.directory, fname))
+                except FileNotFoundError:  # evicted meanwhile by another process sharing the directory
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, fname))
+        total = sum(size for _, size, _ in entries)
+        for _, size, fname in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.directory, fname))
+            except FileNotFoundError:  # already evicted by another process
+                pass
+            total -= size
+
+
+def _no_stage(name):
+    return contextlib.nullcontext({})
+
+
+def init_fields(gc, positions_dir='positions', cache=None, stage=_no_stage, tile=None, workers=None, prefetch=0,
+                binary=False):
+    """ init_velocity_field, scale_velocity_field and calc_rotor of gc, served from cache when possible
+
+        stage(name) is a context manager around each step, see PedtoolsAction.stage. prefetch and binary
+        are passed to init_velocity_field, tile and workers to calc_rotor. Returns True when the fields came
+        from the cache.
+    """
+    num_grids = gc.num_repetitions * gc.num_timesteps
+    if cache is not None:
+        with stage('cache') as record:
+            key = cache.key(positions_files(positions_dir, gc.num_repetitions, binary), gc.geometry)
+            hit = cache.load(key, gc)
+            record['items'] = num_grids if hit else 0
+        if hit:
+            return True
+    with stage('ingest') as record:
+        gc.init_velocity_field(positions_dir, prefetch, binary)
+        record['items'] = int(gc.update_count.sum())  # frames
+    with stage('scale') as record:
+        gc.scale_velocity_field()
+        record['items'] = num_grids
+    with stage('rotor') as record:
+        gc.calc_rotor(tile=tile, workers=workers)
+        record['items'] = num_grids
+    if cache is not None:
+        with stage('cache_store'):
+            cache.store(key, gc)
+    return False
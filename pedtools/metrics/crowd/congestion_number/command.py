@@ -0,0 +1,222 @@
+import argparse
+import functools
+import os
+from typing import List, Optional
+
+from pedtools.commands.action import PedtoolsAction
+
+
+class CongestionNumberCommand(PedtoolsAction):
+    """ Congestion number statistics of the positions/pos_{rep}.dat files described by a parameters file """
+
+    def help_description(self) -> Optional[str]:
+        return "Congestion number of pedestrian trajectories"
+
+    def action_flags(self) -> List[argparse.ArgumentParser]:
+        parser = argparse.ArgumentParser(add_help=False)
+        parser.add_argument('--parameters', default='parameters', help='Parameters file of the study')
+        parser.add_argument('--positions', default='positions', help='Directory holding the pos_{rep}.dat files')
+        parser.add_argument('--cn-radius', type=float, default=None,
+                            help='CN radius in cells, overrides cn_radius of the parameters file')
+        parser.add_argument('--cn-radii', type=float, nargs='+', default=None,
+                            help='Sweep over several CN radii in one pass, statistics go to OUTPUT/r_<radius>')
+        parser.add_argument('--output', default='.', help='Directory the statistics files are written to')
+        parser.add_argument('--fields', default=None,
+                            help='Write the v, rot, cn and dens fields of every grid to this .npz file')
+        parser.add_argument('--no-compress', action='store_true', help='Store the --fields file uncompressed')
+        parser.add_argument('--storage', default=None,
+                            help='Keep the fields in memory-mapped files in this directory instead of in RAM')
+        parser.add_argument('--cache', default=None,
+                            help='Directory caching the radius independent fields between runs on the same data')
+        parser.add_argument('--cache-size', type=float, default=None, help='Size cap of --cache in MB, 1024 by default')
+        parser.add_argument('--text-fields', action='store_true',
+                            help='Also export the fields as one text file per grid and field under data/')
+        parser.add_argument('--streaming', action='store_true',
+                            help='Process one time bin at a time instead of holding the whole study in memory')
+        parser.add_argument('--workers', type=int, default=None,
+                            help='Number of processes the repetitions are spread over, implies --streaming '
+                                 '(1 by default)')
+        parser.add_argument('--batch', default=None, metavar='MANIFEST',
+                            help='Run every dataset listed in this YAML manifest in one process')
+        parser.add_argument('--results', default=None,
+                            help='JSON file collecting the statistics of every --batch dataset, '
+                                 'batch_results.json by default')
+        parser.add_argument('--tile', type=int, default=None,
+                            help='Store the streamed grid sparsely in tiles of TILE x TILE cells (at least 2), '
+                                 'implies --streaming')
+        parser.add_argument('--spatial-tile', type=int, default=None, metavar='CELLS',
+                            help='Compute the rotor and CN on CELLS x CELLS blocks of the grid, for large areas')
+        parser.add_argument('--threads', type=int, default=None,
+                            help='Threads processing the --spatial-tile blocks, all cores by default')
+        parser.add_argument('--prefetch', type=int, default=0, metavar='DEPTH',
+                            help='Read and parse the positions files in a background thread, up to DEPTH '
+                                 'blocks of frames ahead of the computation')
+        parser.add_argument('--time-window', type=float, nargs=2, default=None, metavar=('START', 'END'),
+                            help='Only use the frames with START <= time < END (inf for no bound) and report '
+                                 'the time bins overlapping them')
+        parser.add_argument('--binary-positions', action='store_true',
+                            help='Read the pos_{rep}.bin files written by convert_positions (float32 positions '
+                                 'and velocities, indexed by time) instead of pos_{rep}.dat')
+        parser.add_argument('--cn-threshold', type=float, default=None, metavar='THRESHOLD',
+                            help='Compute the exact CN only in the blocks where it may exceed THRESHOLD and an '
+                                 'upper bound elsewhere, written with the cn_exact mask to --fields, without '
+                                 'statistics')
+        parser.add_argument('--cn-block', type=int, default=32,
+                            help='Side in cells of the blocks refined by --cn-threshold')
+        parser.add_argument('--stream', default=None, metavar='SOURCE',
+                            help='Read a live feed from - (stdin), tcp://HOST:PORT or unix://PATH and print '
+                                 'the CN statistics of each time bin as it closes')
+        parser.add_argument('--queue-size', type=int, default=64,
+                            help='Frames buffered between parsing and computation in --stream mode')
+        return [parser]
+
+    def action(self, config: dict):
+        if config.get('cite'):
+            print("See the paper: https://arxiv.org/abs/2004.01883")
+            return
+        # imported here rather than at the top, so that building the CLI does not import numpy and asyncio
+        import asyncio
+        from pedtools.metrics.crowd.congestion_number.cache import FieldCache, init_fields
+        from pedtools.metrics.crowd.congestion_number.congestion_number import (GridCollection, Params, Statistics,
+                                                                                StreamingGridCollection,
+                                                                                calc_sweep_statistics)
+        from pedtools.metrics.crowd.congestion_number.stream import serve
+
+        if config.get('batch'):
+            from pedtools.metrics.crowd.congestion_number.batch import run_batch
+            # flags left unset fall back on the manifest
+            cache_size = config.get('cache_size')
+            content = run_batch(config['batch'], results=config.get('results'), workers=config.get('workers'),
+                                cache_dir=config.get('cache'),
+                                cache_size=None if cache_size is None else float(cache_size) * 2 ** 20)
+            failed = [entry['name'] for entry in content['datasets'] if 'error' in entry]
+            if failed:
+                raise ValueError(f"{len(failed)} of {len(content['datasets'])} datasets failed: {failed}, "
+                                 f"see {content['results']}")
+            return
+
+        params = Params(config['parameters'])
+        cn_radius = config.get('cn_radius')
+        if cn_radius is None and not config.get('cn_radii'):
+            if 'cn_radius' not in params.params:
+                raise ValueError("cn_radius is neither in the parameters file nor given with --cn-radius")
+            cn_radius = params.params['cn_radius']
+
+        if config.get('stream'):
+            if config.get('fields') or config.get('text_fields') or config.get('cache') or config.get('cn_radii'):
+                raise ValueError("--fields, --text-fields, --cache and --cn-radii need the whole study, drop --stream")
+            try:
+                asyncio.run(serve(config['stream'], params.grid_args()[2:], cn_radius,
+                                  queue_size=int(config.get('queue_size') or 64)))
+            except KeyboardInterrupt:
+                pass
+            return
+
+        workers = int(config.get('workers') or 1)
+        if config.get('tile') is not None and config['tile'] < 2:
+            raise ValueError(f"--tile must be at least 2, got {config['tile']}")
+        streaming = config.get('streaming') or workers > 1 or config.get('tile') is not None
+        if streaming and (config.get('fields') or config.get('text_fields') or config.get('cache') or
+                          config.get('cn_radii') or config.get('cn_threshold') is not None):
+            raise ValueError("--fields, --text-fields, --cache, --cn-radii and --cn-threshold need the whole study "
+                             "in memory, drop --streaming/--workers/--tile")
+        if config.get('cn_threshold') is not None and not config.get('fields'):
+            raise ValueError("--cn-threshold writes its result to --fields, which is missing")
+        stage = functools.partial(self.stage, config)
+        num_grids = params.grid_args()[0] * params.grid_args()[1]
+        if streaming:
+            sgc = StreamingGridCollection(*params.grid_args(), tile=config.get('tile'),
+                                          spatial_tile=config.get('spatial_tile'), threads=config.get('threads'),
+                                          prefetch=int(config.get('prefetch') or 0),
+                                          time_window=config.get('time_window'))
+            with stage('stream') as record:
+                stats = sgc.run(cn_radius, config['positions'], workers=workers,
+                                binary=config.get('binary_positions'))
+                record['items'] = num_grids
+            for name, (elapsed, items) in sgc.timings.items():  # the stages within stream, summed over the bins
+                self.report_stage(config, name, elapsed, items)
+        else:
+            gc = GridCollection(*params.grid_args(), storage=config.get('storage'),
+                                time_window=config.get('time_window'))
+            cache = None
+            if config.get('cache'):
+                cache = FieldCache(config['cache'], max_bytes=float(config.get('cache_size') or 1024) * 2 ** 20)
+            init_fields(gc, config['positions'], cache, stage=stage, tile=config.get('spatial_tile'),
+                        workers=config.get('threads'), prefetch=int(config.get('prefetch') or 0),
+                        binary=config.get('binary_positions'))
+            if config.get('cn_radii'):
+                with stage('cn') as record:
+                    sweep = calc_sweep_statistics(gc, config['cn_radii'])
+                    record['items'] = num_grids * len(sweep)
+                with stage('write') as record:
+                    for radius, stats in sweep.items():
+                        out_dir = os.path.join(config['output'], f'r_{radius:g}')
+                        os.makedirs(out_dir, exist_ok=True)
+                        stats.write_to_files(out_dir)
+                    record['items'] = len(sweep) * len(Statistics.FIELDS)
+                return
+            if config.get('cn_threshold') is not None:
+                with stage('cn') as record:
+                    cn_exact = gc.calc_cn_adaptive(cn_radius, config['cn_threshold'], int(config.get('cn_block') or 32))
+                    gc.flush()
+                    record['items'] = num_grids
+                with stage('write_fields') as record:
+                    gc.write_fields(config['fields'], compress=not config.get('no_compress'), cn_exact=cn_exact)
+                    record['items'] = num_grids
+                return
+            with stage('cn') as record:
+                gc.calc_cn(cn_radius, tile=config.get('spatial_tile'), workers=config.get('threads'))
+                gc.flush()
+                record['items'] = num_grids
+            with stage('statistics') as record:
+                stats = Statistics(gc)
+                stats.calc_statistics()
+                record['items'] = num_grids
+            if config.get('fields') or config.get('text_fields'):
+                with stage('write_fields') as record:
+                    if config.get('fields'):
+                        gc.write_fields(config['fields'], compress=not config.get('no_compress'))
+                    if config.get('text_fields'):
+                        os.makedirs('data', exist_ok=True)
+                        gc.write_velocity()
+                        gc.write_rotor()
+                        gc.write_cn()
+                    record['items'] = num_grids
+        with stage('write') as record:
+            os.makedirs(config['output'], exist_ok=True)
+            stats.write_to_files(config['output'])
+            record['items'] = len(Statistics.FIELDS)
+
+congestion_number = CongestionNumberCommand()
+
+
+class ConvertPositionsCommand(PedtoolsAction):
+    """ Converts the positions/pos_{rep}.dat text files into indexed binary pos_{rep}.bin files """
+
+    def help_description(self) -> Optional[str]:
+        return "Convert positions files to the indexed binary format"
+
+    def action_flags(self) -> List[argparse.ArgumentParser]:
+        parser = argparse.ArgumentParser(add_help=False)
+        parser.add_argument('--positions', default='positions', help='Directory holding the pos_{rep}.dat files')
+        parser.add_argument('--output', default=None,
+                            help='Directory the pos_{rep}.bin files are written to, --positions by default')
+        return [parser]
+
+    def action(self, config: dict):
+        from pedtools.metrics.crowd.congestion_number.positions import write_binary_positions
+
+        output = config.get('output') or config['positions']
+        os.makedirs(output, exist_ok=True)
+        fnames = sorted(fname for fname in os.listdir(config['positions'])
+                        if fname.startswith('pos_') and fname.endswith('.dat'))
+        if not fnames:
+            raise ValueError(f"No pos_{{rep}}.dat file in {config['positions']}")
+        with self.stage(config, 'convert') as record:
+            for fname in fnames:
+                header = write_binary_positions(os.path.join(config['positions'], fname),
+                                                os.path.join(output, fname[:-len('.dat')] + '.bin'))
+                record['items'] += int(header['num_frames'])
+
+
+convert_positions = ConvertPositionsCommand()
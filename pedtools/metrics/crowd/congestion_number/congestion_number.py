@@ -1,4 +1,17 @@
+import collections
+import concurrent.futures
+import functools
+import itertools
+import json
 import math
+import os
+import sys
+import time
+import zipfile
+
+import numpy as np
+
+from pedtools.metrics.crowd.congestion_number.positions import blocks_by_file, positions_files, read_positions
 
 
 class Vec2D(object):
@@ -27,6 +40,249 @@ class Vec2D(object):
         return f'{self.x:.5f} {self.y:.5f}'
 
 
+@functools.lru_cache(maxsize=None)
+def cn_footprint(cn_radius):
+    """ Offsets (l, m) of the circular CN neighbourhood, in the scan order of the loop engine """
+    d_cnr = int(cn_radius) + 1
+    return tuple((l, m) for l in range(-d_cnr, d_cnr) for m in range(-d_cnr, d_cnr)
+                 if math.sqrt(l * l + m * m) <= cn_radius)
+
+
+def _pad_cn_inputs(vx, vy, rot, rotval, d_cnr):
+    """ rot for the windowed max and min and |v|, padded by d_cnr cells with neutral values """
+    pad = [(0, 0)] * (vx.ndim - 2) + [(d_cnr, d_cnr)] * 2
+    rot_hi = np.pad(np.where(rotval, rot, -np.inf), pad, constant_values=-np.inf)
+    rot_lo = np.pad(np.where(rotval, rot, np.inf), pad, constant_values=np.inf)
+    speed = np.pad(np.sqrt(vx ** 2 + vy ** 2), pad)
+    return rot_hi, rot_lo, speed
+
+
+def _cn_from_window(maxr, minr, vav, conta_v, delta_x):
+    cn = np.zeros(maxr.shape)
+    defined = (conta_v > 0) & (maxr != -np.inf)  # zero if v nowhere or rot nowhere
+    cn[defined] = delta_x * (maxr[defined] - minr[defined]) / (
+            vav[defined] / conta_v[defined] * 6)  # Needs to be updated for different dx dy
+    return cn
+
+
+def calc_cn_field(vx, vy, rot, rotval, cn_radius, delta_x):
+    """ Vectorised congestion number over the last two axes of the given fields
+
+        Each footprint offset is applied as a shifted view of the padded fields, so the windowed
+        max/min of rot and the running sum of the nonzero |v| are accumulated in the same order as
+        the loop engine. Results agree with it up to the last bit of |v| (x * x against x ** 2).
+    """
+    d_cnr = int(cn_radius) + 1
+    x_size, y_size = vx.shape[-2:]
+    rot_hi, rot_lo, speed = _pad_cn_inputs(vx, vy, rot, rotval, d_cnr)
+    maxr = np.full(vx.shape, -np.inf)
+    minr = np.full(vx.shape, np.inf)
+    vav = np.zeros(vx.shape)
+    conta_v = np.zeros(vx.shape, dtype=np.int32)
+    for l, m in cn_footprint(cn_radius):
+        window = (Ellipsis, slice(d_cnr + l, d_cnr + l + x_size), slice(d_cnr + m, d_cnr + m + y_size))
+        np.maximum(maxr, rot_hi[window], out=maxr)
+        np.minimum(minr, rot_lo[window], out=minr)
+        vav += speed[window]  # zero where the velocity is not defined
+        conta_v += speed[window] > 0
+    return _cn_from_window(maxr, minr, vav, conta_v, delta_x)
+
+
+def calc_cn_sweep_field(vx, vy, rot, rotval, radii, delta_x):
+    """ calc_cn_field for several radii in a single pass, returns {radius: cn}
+
+        The footprint offsets of the largest radius are visited by increasing distance, so the window
+        of each radius extends the running max/min/sum of the smaller ones. The |v| sums are added in
+        a different order than calc_cn_field, results agree with it to rounding.
+    """
+    radii = sorted(set(radii))
+    d_cnr = int(radii[-1]) + 1
+    x_size, y_size = vx.shape[-2:]
+    rot_hi, rot_lo, speed = _pad_cn_inputs(vx, vy, rot, rotval, d_cnr)
+    maxr = np.full(vx.shape, -np.inf)
+    minr = np.full(vx.shape, np.inf)
+    vav = np.zeros(vx.shape)
+    conta_v = np.zeros(vx.shape, dtype=np.int32)
+    offsets = sorted(cn_footprint(radii[-1]), key=lambda lm: math.sqrt(lm[0] * lm[0] + lm[1] * lm[1]))
+    cn = {}
+    pending = iter(radii)
+    radius = next(pending)
+    for l, m in offsets:
+        while math.sqrt(l * l + m * m) > radius:  # window of radius complete
+            cn[radius] = _cn_from_window(maxr, minr, vav, conta_v, delta_x)
+            radius = next(pending)
+        window = (Ellipsis, slice(d_cnr + l, d_cnr + l + x_size), slice(d_cnr + m, d_cnr + m + y_size))
+        np.maximum(maxr, rot_hi[window], out=maxr)
+        np.minimum(minr, rot_lo[window], out=minr)
+        vav += speed[window]
+        conta_v += speed[window] > 0
+    for radius in itertools.chain([radius], pending):
+        cn[radius] = _cn_from_window(maxr, minr, vav, conta_v, delta_x)
+    return cn
+
+
+def scale_velocity(vx, vy, dens, update_count, delta_x, delta_y):
+    """ Turns velocity sums and pedestrian counts into average velocity and density, in place
+
+        Works on a grid or a stack of grids, the cells being the last two axes, update_count holding the
+        number of frames of each grid (shape dens.shape[:-2]). Returns the mask of cells with a positive
+        density.
+    """
+    occupied = dens > 0
+    inv_dens = 1 / dens[occupied]  # same rounding as Vec2D.__truediv__
+    vx[occupied] *= inv_dens
+    vy[occupied] *= inv_dens
+    update_count = np.broadcast_to(np.asarray(update_count)[..., np.newaxis, np.newaxis], dens.shape)
+    dens[occupied] /= update_count[occupied] * (delta_x * delta_y)
+    return occupied & (dens > 0)
+
+
+def calc_rotor_field(vx, vy, dens, rot, rotval, delta_x):
+    """ Rotor of the velocity field over the last two axes of the given fields, in place """
+    occupied = dens > 0
+    # interior cells whose 4-neighbourhood has a defined velocity field
+    defined = (occupied[..., 2:, 1:-1] & occupied[..., :-2, 1:-1] &
+               occupied[..., 1:-1, 2:] & occupied[..., 1:-1, :-2])
+    inner_rot = (vy[..., 2:, 1:-1] - vy[..., :-2, 1:-1] - vx[..., 1:-1, 2:] + vx[..., 1:-1, :-2]) / (
+            2 * delta_x)  # CHECK
+    rotval[..., 1:-1, 1:-1] |= defined
+    rot[..., 1:-1, 1:-1][defined] = inner_rot[defined]
+
+
+def spatial_tiles(x_size, y_size, tile, halo):
+    """ Yields (inner, outer, crop) for each tile x tile block of an x_size x y_size grid
+
+        inner selects the block in the grid, outer the block grown by halo cells (clipped to the grid)
+        and crop the block within outer. Each is a tuple of two slices.
+    """
+    for x0 in range(0, x_size, tile):
+        for y0 in range(0, y_size, tile):
+            x1, y1 = min(x0 + tile, x_size), min(y0 + tile, y_size)
+            ox0, oy0 = max(x0 - halo, 0), max(y0 - halo, 0)
+            ox1, oy1 = min(x1 + halo, x_size), min(y1 + halo, y_size)
+            yield ((slice(x0, x1), slice(y0, y1)), (slice(ox0, ox1), slice(oy0, oy1)),
+                   (slice(x0 - ox0, x1 - ox0), slice(y0 - oy0, y1 - oy0)))
+
+
+def _map_tiles(fn, x_size, y_size, tile, halo, workers):
+    """ Calls fn(inner, outer, crop) for each spatial tile, on a pool of workers threads """
+    tiles = list(spatial_tiles(x_size, y_size, tile, halo))
+    if workers == 1 or len(tiles) == 1:
+        for t in tiles:
+            fn(*t)
+        return
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:  # numpy releases the GIL
+        for _ in pool.map(lambda t: fn(*t), tiles):  # re-raises the errors of the tiles
+            pass
+
+
+def calc_rotor_field_tiled(vx, vy, dens, rot, rotval, delta_x, tile=256, workers=None):
+    """ calc_rotor_field computed on spatial tiles with a one cell halo, in parallel, in place
+
+        Each tile writes only its own cells, results are identical to calc_rotor_field.
+    """
+    def rotor_tile(inner, outer, crop):
+        outer, inner, crop = (Ellipsis,) + outer, (Ellipsis,) + inner, (Ellipsis,) + crop
+        tile_rot = np.zeros(dens[outer].shape)
+        tile_rotval = np.zeros(dens[outer].shape, dtype=bool)
+        calc_rotor_field(vx[outer], vy[outer], dens[outer], tile_rot, tile_rotval, delta_x)
+        defined = tile_rotval[crop]
+        rotval[inner] |= defined
+        rot[inner][defined] = tile_rot[crop][defined]
+
+    _map_tiles(rotor_tile, *dens.shape[-2:], tile, 1, workers)
+
+
+def calc_cn_field_tiled(vx, vy, rot, rotval, cn_radius, delta_x, tile=256, workers=None):
+    """ calc_cn_field computed on spatial tiles in parallel and stitched together
+
+        Tiles carry a halo of ceil(cn_radius) + 1 cells, which holds the whole CN footprint of their
+        border cells, so results are identical to calc_cn_field. Peak memory scales with the tiles
+        in flight rather than with the grid.
+    """
+    cn = np.zeros(vx.shape)
+
+    def cn_tile(inner, outer, crop):
+        outer = (Ellipsis,) + outer
+        cn[(Ellipsis,) + inner] = calc_cn_field(vx[outer], vy[outer], rot[outer], rotval[outer], cn_radius,
+                                                delta_x)[(Ellipsis,) + crop]
+
+    _map_tiles(cn_tile, *vx.shape[-2:], tile, math.ceil(cn_radius) + 1, workers)
+    return cn
+
+
+def _block_reduce(field, block, fill, ufunc):  # ufunc (np.maximum, np.minimum) of each block x block block
+    x_size, y_size = field.shape[-2:]
+    nbx, nby = -(-x_size // block), -(-y_size // block)
+    pad = [(0, 0)] * (field.ndim - 2) + [(0, nbx * block - x_size), (0, nby * block - y_size)]
+    field = np.pad(field, pad, constant_values=fill)
+    return ufunc.reduce(field.reshape(field.shape[:-2] + (nbx, block, nby, block)), axis=(-3, -1))
+
+
+def _dilate(field, k, fill, ufunc):  # ufunc over the (2k + 1) x (2k + 1) neighbourhood of each cell
+    x_size, y_size = field.shape[-2:]
+    padded = np.pad(field, [(0, 0)] * (field.ndim - 2) + [(k, k)] * 2, constant_values=fill)
+    out = field.copy()
+    for l in range(2 * k + 1):
+        for m in range(2 * k + 1):
+            ufunc(out, padded[..., l:l + x_size, m:m + y_size], out=out)
+    return out
+
+
+def cn_upper_bound(vx, vy, rot, rotval, cn_radius, delta_x, block=32):
+    """ Upper bound of the CN of the cells of each block x block block, over the last two axes
+
+        The footprint of a cell lies in its block dilated by int(cn_radius) + 1 cells, so
+        delta_x * (max rot - min rot) / (6 * min nonzero |v|) over the dilated block bounds the CN of
+        all its cells. The max/min are taken on a coarse level of one value per block, then over the
+        neighbouring blocks covering the dilation. Returns (..., ceil(x_size / block), ceil(y_size / block)),
+        zero where the CN of the whole block is zero.
+    """
+    k = -(-(int(cn_radius) + 1) // block)  # blocks covering the dilation
+    speed = np.sqrt(vx ** 2 + vy ** 2)
+    rot_max = _dilate(_block_reduce(np.where(rotval, rot, -np.inf), block, -np.inf, np.maximum), k, -np.inf,
+                      np.maximum)
+    rot_min = _dilate(_block_reduce(np.where(rotval, rot, np.inf), block, np.inf, np.minimum), k, np.inf, np.minimum)
+    speed_min = _dilate(_block_reduce(np.where(speed > 0, speed, np.inf), block, np.inf, np.minimum), k, np.inf,
+                        np.minimum)
+    bound = np.zeros(rot_max.shape)
+    defined = (rot_max != -np.inf) & (speed_min != np.inf)
+    bound[defined] = delta_x * (rot_max[defined] - rot_min[defined]) / (6 * speed_min[defined])
+    return bound * (1 + 1e-9)  # the mean |v| of the exact CN can round below the min
+
+
+def calc_cn_field_adaptive(vx, vy, rot, rotval, cn_radius, delta_x, threshold, block=32):
+    """ calc_cn_field computed only in the blocks whose cn_upper_bound exceeds threshold
+
+        Returns (cn, exact): cn is exact in the refined blocks and holds the bound of the block
+        elsewhere, exact marks the cells holding an exact value, including those whose bound is zero
+        as their CN is zero. Every cell whose CN exceeds threshold is therefore exact. The refined
+        blocks carry the halo of calc_cn_field_tiled, so their values are identical to calc_cn_field.
+    """
+    x_size, y_size = vx.shape[-2:]
+    bound = cn_upper_bound(vx, vy, rot, rotval, cn_radius, delta_x, block)
+    cn = np.repeat(np.repeat(bound, block, axis=-2), block, axis=-1)[..., :x_size, :y_size]
+    exact = cn == 0
+    refine = bound > threshold
+    halo = math.ceil(cn_radius) + 1
+    for idx in np.ndindex(refine.shape[:-1]):  # runs of refined blocks along y are computed together
+        *lead, bx = idx
+        lead = tuple(lead)
+        flags = np.concatenate(([False], refine[idx], [False]))
+        starts, = np.nonzero(flags[1:] & ~flags[:-1])
+        stops, = np.nonzero(~flags[1:] & flags[:-1])
+        x0, x1 = bx * block, min((bx + 1) * block, x_size)
+        for by0, by1 in zip(starts.tolist(), stops.tolist()):
+            y0, y1 = by0 * block, min(by1 * block, y_size)
+            ox0, oy0 = max(x0 - halo, 0), max(y0 - halo, 0)
+            outer = lead + (slice(ox0, min(x1 + halo, x_size)), slice(oy0, min(y1 + halo, y_size)))
+            inner = lead + (slice(x0, x1), slice(y0, y1))
+            cn[inner] = calc_cn_field(vx[outer], vy[outer], rot[outer], rotval[outer], cn_radius, delta_x)[
+                ..., x0 - ox0:x1 - ox0, y0 - oy0:y1 - oy0]
+            exact[inner] = True
+    return cn, exact
+
+
 class VelCell:
     def __init__(self):
         self.v = Vec2D()
@@ -43,13 +299,15 @@ class VelCell:
 
 class Grid:
     def __init__(self, CellType, x_size=5, y_size=5, delta_x=1, delta_y=1, x_min=0, y_min=0):
-        self.cell_list = []  # empty list to hold all cells
         self.delta_x = float(delta_x)
         self.delta_y = float(delta_y)
         self.x_min = float(x_min)
         self.y_min = float(y_min)
         self.x_size = int(x_size)
         self.y_size = int(y_size)
+        if CellType is None:  # storage provided by the child class
+            return
+        self.cell_list = []  # empty list to hold all cells
         for col in range(self.x_size):
             col_list = []
             for row in range(self.y_size):
@@ -62,9 +320,9 @@ class Grid:
 
     def valid_idx(self, x_idx, y_idx):
         valid = True
-        if (x_idx >= len(self.cell_list)) or x_idx < 0:
+        if (x_idx >= self.x_size) or x_idx < 0:
             valid = False
-        if (y_idx >= len(self.cell_list[x_idx])) or y_idx < 0:
+        if (y_idx >= self.y_size) or y_idx < 0:
             valid = False
         return valid
 
@@ -85,55 +343,194 @@ class Grid:
 
 class BoolGrid(Grid):
     def __init__(self, x_size=5, y_size=5, delta_x=1, delta_y=1, x_min=0, y_min=0):
-        super().__init__(bool, x_size, y_size, delta_x, delta_y, x_min, y_min)
+        super().__init__(None, x_size, y_size, delta_x, delta_y, x_min, y_min)
+        # a 2D bool array indexes like the list of lists it replaces: in_area[i][j]
+        self.cell_list = np.zeros((self.x_size, self.y_size), dtype=bool)
+
+
+def _field_property(name):
+    def fget(self):
+        return getattr(self._grid, name)[self._i, self._j].item()
+
+    def fset(self, value):
+        getattr(self._grid, name)[self._i, self._j] = value
+
+    return property(fget, fset)
+
+
+class VelCellView:
+    """ VelCell look-alike reading and writing one (i, j) entry of a VelocityGrid """
+    __slots__ = ('_grid', '_i', '_j')
+
+    def __init__(self, grid, i, j):
+        self._grid = grid
+        self._i = i
+        self._j = j
+
+    dens = _field_property('dens')
+    rotval = _field_property('rotval')
+    rot = _field_property('rot')
+    cn = _field_property('cn')
+
+    @property
+    def update_count(self):  # frames binned into the whole grid
+        return self._grid.update_count.item()
+
+    @update_count.setter
+    def update_count(self, value):
+        self._grid.update_count[...] = value
+
+    @property
+    def v(self):
+        return Vec2D(self._grid.vx[self._i, self._j].item(), self._grid.vy[self._i, self._j].item())
+
+    @v.setter
+    def v(self, new_v):
+        self._grid.vx[self._i, self._j] = new_v.x
+        self._grid.vy[self._i, self._j] = new_v.y
+
+    def add(self, new_v):
+        self._grid.vx[self._i, self._j] += new_v.x
+        self._grid.vy[self._i, self._j] += new_v.y
+        self._grid.dens[self._i, self._j] += 1
+
+
+class VelColumnView:
+    """ Column i of a VelocityGrid, so that grid[i][j] keeps returning a cell """
+    __slots__ = ('_grid', '_i')
+
+    def __init__(self, grid, i):
+        self._grid = grid
+        self._i = i
+
+    def __len__(self):
+        return self._grid.y_size
+
+    def __getitem__(self, j):
+        if j < -self._grid.y_size or j >= self._grid.y_size:
+            raise IndexError('cell index out of range')
+        return VelCellView(self._grid, self._i, j % self._grid.y_size)
+
+    def __iter__(self):
+        for j in range(self._grid.y_size):
+            yield VelCellView(self._grid, self._i, j)
 
 
 class VelocityGrid(Grid):
-    def __init__(self, rep_id, x_size=5, y_size=5, delta_x=1, delta_y=1, x_min=0, y_min=0):
+    """ Velocity field stored as one contiguous array per cell attribute
+
+        vx, vy, dens, rot and cn are float64 arrays and rotval a bool array, all of shape
+        (x_size, y_size): 41 bytes per cell, against about 300 bytes for a VelCell holding a Vec2D.
+        update_count, the number of frames binned into the grid, is the same for every cell and kept
+        as a single 0-d array. grid[i][j] returns a VelCellView on those arrays. fields can hand in
+        existing arrays (e.g. slices of a GridCollection) instead.
+    """
+    FIELDS = (('vx', np.float64), ('vy', np.float64), ('dens', np.float64), ('rot', np.float64),
+              ('rotval', np.bool_), ('cn', np.float64))
+
+    def __init__(self, rep_id, x_size=5, y_size=5, delta_x=1, delta_y=1, x_min=0, y_min=0, fields=None):
         self.rep_id = int(rep_id)
-        # self.update_count=0
-        super().__init__(VelCell, x_size, y_size, delta_x, delta_y, x_min, y_min)
+        super().__init__(None, x_size, y_size, delta_x, delta_y, x_min, y_min)
+        for name, dtype in self.FIELDS:
+            if fields is not None:
+                setattr(self, name, fields[name])
+            else:
+                setattr(self, name, np.zeros((self.x_size, self.y_size), dtype=dtype))
+        self.update_count = fields['update_count'] if fields is not None else np.zeros((), dtype=np.int64)
+
+    def clear(self):
+        for name, _ in self.FIELDS:
+            getattr(self, name)[...] = 0
+        self.update_count[...] = 0
+
+    def __getitem__(self, index):
+        if index < -self.x_size or index >= self.x_size:
+            raise IndexError('cell index out of range')
+        return VelColumnView(self, index % self.x_size)
+
+    @property
+    def cell_list(self):
+        return [VelColumnView(self, i) for i in range(self.x_size)]
 
     def update_velocity_field(self, ped_state):
 
         x_idx = int((ped_state['x'] - self.x_min) / self.delta_x)
         y_idx = int((ped_state['y'] - self.y_min) / self.delta_y)
         if self.valid_idx(x_idx, y_idx):
-            # self.update_count+=1
-            self.cell_list[x_idx][y_idx].add(ped_state['v'])
+            self.vx[x_idx, y_idx] += ped_state['v'].x
+            self.vy[x_idx, y_idx] += ped_state['v'].y
+            self.dens[x_idx, y_idx] += 1
         else:
             print(f" Ignoring pedestrian at x: {ped_state['x']},y: {ped_state['y']}, rep: {self.rep_id}")
 
+    def cell_idx(self, x, y):
+        """ Vectorised counterpart of the update_velocity_field binning, returns x_idx, y_idx, valid """
+        x_idx = ((np.asarray(x) - self.x_min) / self.delta_x).astype(np.int64)  # truncates like int()
+        y_idx = ((np.asarray(y) - self.y_min) / self.delta_y).astype(np.int64)
+        valid = (x_idx >= 0) & (x_idx < self.x_size) & (y_idx >= 0) & (y_idx < self.y_size)
+        return x_idx, y_idx, valid
+
+    def add_pedestrians(self, x, y, vx, vy):
+        """ update_velocity_field for arrays of pedestrians, as one scatter-add per field """
+        x_idx, y_idx, valid = self.cell_idx(x, y)
+        for ped_x, ped_y in zip(np.asarray(x)[~valid].tolist(), np.asarray(y)[~valid].tolist()):
+            print(f" Ignoring pedestrian at x: {ped_x},y: {ped_y}, rep: {self.rep_id}")
+        idx = (x_idx[valid], y_idx[valid])
+        # np.add.at adds in input order, giving the same sums as one update per pedestrian
+        np.add.at(self.vx, idx, np.asarray(vx)[valid])
+        np.add.at(self.vy, idx, np.asarray(vy)[valid])
+        np.add.at(self.dens, idx, 1)
+
     def scale_velocity_field(self, in_area):
-        for i in range(self.x_size):
-            for j in range(self.y_size):
-                cell = self.cell_list[i][j]
-                if cell.dens > 0:
-                    cell.v /= cell.dens
-                    # print(cell.dens,cell.update_count)
-                    cell.dens /= cell.update_count * (self.delta_x * self.delta_y)
-                    if cell.dens > 0:
-                        in_area[i][j] = True
+        in_area.cell_list[scale_velocity(self.vx, self.vy, self.dens, self.update_count, self.delta_x,
+                                         self.delta_y)] = True
 
     def check_neighs(self, i, j):  # checks if velocity field defined in neighs
-        grid = self.cell_list
-        if ((grid[i - 1][j].dens > 0) and (grid[i + 1][j].dens > 0) and (grid[i][j - 1].dens > 0) and (
-                grid[i][j + 1].dens > 0)):
+        dens = self.dens
+        if ((dens[i - 1, j] > 0) and (dens[i + 1, j] > 0) and (dens[i, j - 1] > 0) and (dens[i, j + 1] > 0)):
             return True
         return False
 
-    def calc_rotor(self):
-        grid = self.cell_list
-        for i in range(1, self.x_size - 1):
-            for j in range(1, self.y_size - 1):
-                if self.check_neighs(i, j):
-                    grid[i][j].rotval = True
-                    grid[i][j].rot = (grid[i + 1][j].v.y - grid[i - 1][j].v.y - grid[i][j + 1].v.x + grid[i][
-                        j - 1].v.x) / (2 * self.delta_x)  # CHECK
+    def calc_rotor(self, tile=None, workers=None):
+        """ With tile, the rotor is computed on tile x tile blocks by workers threads """
+        if tile:
+            calc_rotor_field_tiled(self.vx, self.vy, self.dens, self.rot, self.rotval, self.delta_x, tile, workers)
+            return
+        calc_rotor_field(self.vx, self.vy, self.dens, self.rot, self.rotval, self.delta_x)
 
-    def calc_cn(self, cn_radius):
+    def calc_cn(self, cn_radius, engine='vectorized', tile=None, workers=None):
+        """ engine='vectorized' uses calc_cn_field, engine='loop' the cell by cell reference scan
+
+            With tile, the vectorized engine runs on tile x tile blocks by workers threads, see
+            calc_cn_field_tiled.
+        """
+        if engine == 'vectorized' and tile:
+            self.cn[...] = calc_cn_field_tiled(self.vx, self.vy, self.rot, self.rotval, cn_radius, self.delta_x,
+                                               tile, workers)
+        elif engine == 'vectorized':
+            self.cn[...] = calc_cn_field(self.vx, self.vy, self.rot, self.rotval, cn_radius, self.delta_x)
+        elif engine == 'loop':
+            self._calc_cn_loop(cn_radius)
+        else:
+            raise ValueError(f"Unknown CN engine: {engine}")
+
+    def calc_cn_adaptive(self, cn_radius, threshold, block=32):
+        """ Exact CN only where it may exceed threshold, see calc_cn_field_adaptive, returns the exact mask """
+        self.cn[...], exact = calc_cn_field_adaptive(self.vx, self.vy, self.rot, self.rotval, cn_radius,
+                                                     self.delta_x, threshold, block)
+        return exact
+
+    def calc_cn_sweep(self, radii):
+        """ CN field for each of radii, as {radius: array}, leaving self.cn untouched """
+        return calc_cn_sweep_field(self.vx, self.vy, self.rot, self.rotval, radii, self.delta_x)
+
+    def _calc_cn_loop(self, cn_radius):
         d_cnr = int(cn_radius) + 1  # r=3.5-> d_cnr=4 for loop on neighs
-        grid = self.cell_list
+        rotval = self.rotval.tolist()
+        rot = self.rot.tolist()
+        vx = self.vx.tolist()
+        vy = self.vy.tolist()
+        cn = self.cn
         for i in range(self.x_size):
             for j in range(self.y_size):
                 conta_v = 0  # number of non zero vel cells
@@ -145,39 +542,290 @@ class VelocityGrid(Grid):
                         r = math.sqrt(l * l + m * m)  # euclidean condition
                         if (((i + l) >= 0) and ((j + m) >= 0) and ((i + l) < self.x_size) and (
                                 (j + m) < self.y_size) and (r <= cn_radius)):
-                            if grid[i + l][j + m].rotval:  # if rot defined looks for max and min
-                                if grid[i + l][j + m].rot > maxr:
-                                    maxr = grid[i + l][j + m].rot
-                                if grid[i + l][j + m].rot < minr:
-                                    minr = grid[i + l][j + m].rot
-                            if grid[i + l][j + m].v.magnitude() > 0:  # if vel defined updates average
+                            if rotval[i + l][j + m]:  # if rot defined looks for max and min
+                                if rot[i + l][j + m] > maxr:
+                                    maxr = rot[i + l][j + m]
+                                if rot[i + l][j + m] < minr:
+                                    minr = rot[i + l][j + m]
+                            mag = math.sqrt(vx[i + l][j + m] ** 2 + vy[i + l][j + m] ** 2)
+                            if mag > 0:  # if vel defined updates average
                                 conta_v += 1
-                                vav += grid[i + l][j + m].v.magnitude()
+                                vav += mag
                 if (conta_v):  # computes average and cn
                     vav /= conta_v;
                     if (maxr != float('-inf')) and (minr != float('inf')):
-                        grid[i][j].cn = self.delta_x * (maxr - minr) / (
+                        cn[i, j] = self.delta_x * (maxr - minr) / (
                                 vav * 6)  # Needs to be updated for different dx dy
                     else:
-                        grid[i][j].cn = 0  # zero if v nowhere or rot nowhere
+                        cn[i, j] = 0  # zero if v nowhere or rot nowhere
                 else:
-                    grid[i][j].cn = 0
+                    cn[i, j] = 0
+
+    def write_to_file_v(self, fname):
+        with open(fname, 'w') as fp:
+            for vx_col, vy_col in zip(self.vx.tolist(), self.vy.tolist()):
+                for vx, vy in zip(vx_col, vy_col):
+                    fp.write(f"{vx:.5f} {vy:.5f} ")
+                fp.write('\n')
+
+    def write_to_file(self, fname, attribute='rot'):
+        with open(fname, 'w') as fp:
+            for col in getattr(self, attribute).tolist():
+                for val in col:
+                    fp.write(f"{val:.5f} ")
+                fp.write('\n')
+
+
+class SparseVelocityGrid(Grid):
+    """ VelocityGrid storing only the tiles of tile x tile cells that are in use
+
+        Tiles are allocated when a pedestrian lands in them, each field being a (tiles, tile, tile)
+        array, and tile_map holds the slot of every tile of the grid (-1 if not allocated). scale,
+        rotor and CN work on the allocated tiles only, gathering the tiles around them as a halo, and
+        the CN is only evaluated on the tiles within cn_radius of a defined rotor, being zero elsewhere,
+        so the cost follows the occupied area. The results are those of VelocityGrid, to_dense gives
+        the equivalent VelocityGrid. tile must be at least 2: a cell's rotor needs only its neighbours
+        to be occupied, and with larger tiles one of them always shares the cell's tile.
+    """
+    FIELDS = VelocityGrid.FIELDS
+
+    def __init__(self, rep_id, x_size=5, y_size=5, delta_x=1, delta_y=1, x_min=0, y_min=0, tile=16):
+        if int(tile) < 2:
+            raise ValueError(f"tile must be at least 2, got {tile}")
+        self.rep_id = int(rep_id)
+        super().__init__(None, x_size, y_size, delta_x, delta_y, x_min, y_min)
+        self.tile = int(tile)
+        self.tile_map = np.full((-(-self.x_size // self.tile), -(-self.y_size // self.tile)), -1, dtype=np.int64)
+        self.num_tiles = 0
+        self.tile_x = np.zeros(0, dtype=np.int64)  # tile coordinates of each slot
+        self.tile_y = np.zeros(0, dtype=np.int64)
+        for name, dtype in self.FIELDS:
+            setattr(self, name, np.zeros((1, self.tile, self.tile), dtype=dtype))  # slot num_tiles stays zero
+        self.update_count = np.zeros((), dtype=np.int64)  # frames binned into the grid
+
+    cell_idx = VelocityGrid.cell_idx
+
+    def clear(self):
+        n = self.num_tiles
+        self.tile_map[self.tile_x[:n], self.tile_y[:n]] = -1
+        for name, _ in self.FIELDS:
+            getattr(self, name)[:n] = 0
+        self.num_tiles = 0
+        self.update_count[...] = 0
+
+    def _allocate(self, tx, ty):
+        """ Slots of the tiles (tx, ty), allocating the missing ones """
+        missing = self.tile_map[tx, ty] < 0
+        if missing.any():
+            flat = np.unique(np.ravel_multi_index((tx[missing], ty[missing]), self.tile_map.shape))
+            new_x, new_y = np.unravel_index(flat, self.tile_map.shape)
+            n = self.num_tiles
+            capacity = len(self.vx)
+            if n + new_x.size + 1 > capacity:  # grows by doubling, keeping a zero slot after the last tile
+                capacity = max(2 * capacity, n + new_x.size + 1)
+                for name, dtype in self.FIELDS:
+                    field = np.zeros((capacity, self.tile, self.tile), dtype=dtype)
+                    field[:n] = getattr(self, name)[:n]
+                    setattr(self, name, field)
+                self.tile_x = np.resize(self.tile_x, capacity)
+                self.tile_y = np.resize(self.tile_y, capacity)
+            self.tile_x[n:n + new_x.size] = new_x
+            self.tile_y[n:n + new_y.size] = new_y
+            self.tile_map[new_x, new_y] = np.arange(n, n + new_x.size)
+            self.num_tiles += new_x.size
+        return self.tile_map[tx, ty]
+
+    def add_pedestrians(self, x, y, vx, vy):
+        """ VelocityGrid.add_pedestrians, allocating the tiles the pedestrians land in """
+        x_idx, y_idx, valid = self.cell_idx(x, y)
+        for ped_x, ped_y in zip(np.asarray(x)[~valid].tolist(), np.asarray(y)[~valid].tolist()):
+            print(f" Ignoring pedestrian at x: {ped_x},y: {ped_y}, rep: {self.rep_id}")
+        x_idx = x_idx[valid]
+        y_idx = y_idx[valid]
+        idx = (self._allocate(x_idx // self.tile, y_idx // self.tile), x_idx % self.tile, y_idx % self.tile)
+        np.add.at(self.vx, idx, np.asarray(vx)[valid])
+        np.add.at(self.vy, idx, np.asarray(vy)[valid])
+        np.add.at(self.dens, idx, 1)
+
+    def cells(self, slots):
+        """ Grid indices x_idx, y_idx of the cells of the tiles slots, as (slots, tile, tile) arrays """
+        offsets = np.arange(self.tile)
+        x_idx = self.tile_x[slots][:, np.newaxis, np.newaxis] * self.tile + offsets[:, np.newaxis]
+        y_idx = self.tile_y[slots][:, np.newaxis, np.newaxis] * self.tile + offsets
+        return np.broadcast_arrays(x_idx, y_idx)
+
+    def scale_velocity_field(self, in_area):
+        n = self.num_tiles
+        occupied = scale_velocity(self.vx[:n], self.vy[:n], self.dens[:n], self.update_count, self.delta_x,
+                                  self.delta_y)
+        x_idx, y_idx = self.cells(np.arange(n))
+        in_area.cell_list[x_idx[occupied], y_idx[occupied]] = True
+
+    def _gather(self, name, slots, halo):
+        """ Field name on the tiles slots with halo cells of their neighbouring tiles, zero where missing """
+        rings = -(-halo // self.tile)
+        offsets = np.arange(-rings, rings + 1)
+        nx = self.tile_x[slots][:, np.newaxis, np.newaxis] + offsets[:, np.newaxis]
+        ny = self.tile_y[slots][:, np.newaxis, np.newaxis] + offsets
+        inside = (nx >= 0) & (nx < self.tile_map.shape[0]) & (ny >= 0) & (ny < self.tile_map.shape[1])
+        neighbours = self.tile_map[np.clip(nx, 0, self.tile_map.shape[0] - 1),
+                                   np.clip(ny, 0, self.tile_map.shape[1] - 1)]
+        neighbours[~inside | (neighbours < 0)] = self.num_tiles  # the zero slot
+        side = (2 * rings + 1) * self.tile
+        patch = getattr(self, name)[neighbours].transpose(0, 1, 3, 2, 4).reshape(len(slots), side, side)
+        crop = slice(rings * self.tile - halo, (rings + 1) * self.tile + halo)
+        return patch[:, crop, crop]
+
+    def _slot_batches(self, slots, halo):  # batches of slots whose patches hold about max_batch_cells cells
+        step = max(1, GridCollection.max_batch_cells // (self.tile + 2 * halo) ** 2)
+        for start in range(0, len(slots), step):
+            yield slots[start:start + step]
+
+    def calc_rotor(self):
+        inner = slice(1, self.tile + 1)
+        for slots in self._slot_batches(np.arange(self.num_tiles), 1):
+            vx, vy, dens = (self._gather(name, slots, 1) for name in ('vx', 'vy', 'dens'))
+            rot = np.zeros(vx.shape)
+            rotval = np.zeros(vx.shape, dtype=bool)
+            calc_rotor_field(vx, vy, dens, rot, rotval, self.delta_x)
+            self.rotval[slots] |= rotval[:, inner, inner]
+            self.rot[slots] = np.where(rotval[:, inner, inner], rot[:, inner, inner], self.rot[slots])
+
+    def calc_cn(self, cn_radius):
+        d_cnr = int(cn_radius) + 1
+        rings = -(-d_cnr // self.tile)
+        # tiles within reach of a defined rotor, the CN is zero everywhere else
+        n = self.num_tiles
+        has_rot = self.rotval[:n].any(axis=(1, 2))
+        near = np.zeros(self.tile_map.shape, dtype=bool)
+        near[self.tile_x[:n][has_rot], self.tile_y[:n][has_rot]] = True
+        near = np.pad(near, rings)
+        reach = np.zeros(self.tile_map.shape, dtype=bool)
+        for l in range(2 * rings + 1):
+            for m in range(2 * rings + 1):
+                reach |= near[l:l + self.tile_map.shape[0], m:m + self.tile_map.shape[1]]
+        tx, ty = np.nonzero(reach)
+        inner = slice(d_cnr, d_cnr + self.tile)
+        for slots in self._slot_batches(self._allocate(tx, ty), d_cnr):
+            vx, vy, rot, rotval = (self._gather(name, slots, d_cnr) for name in ('vx', 'vy', 'rot', 'rotval'))
+            cn = calc_cn_field(vx, vy, rot, rotval, cn_radius, self.delta_x)[:, inner, inner]
+            x_idx, y_idx = self.cells(slots)
+            cn[(x_idx >= self.x_size) | (y_idx >= self.y_size)] = 0  # tiles overhanging the grid
+            self.cn[slots] = cn
+
+    def to_dense(self):
+        """ The equivalent VelocityGrid """
+        grid = VelocityGrid(self.rep_id, self.x_size, self.y_size, self.delta_x, self.delta_y, self.x_min, self.y_min)
+        n = self.num_tiles
+        x_idx, y_idx = self.cells(np.arange(n))
+        inside = (x_idx < self.x_size) & (y_idx < self.y_size)
+        for name, _ in self.FIELDS:
+            getattr(grid, name)[x_idx[inside], y_idx[inside]] = getattr(self, name)[:n][inside]
+        grid.update_count[...] = self.update_count
+        return grid
+
+
+def window_bins(num_timesteps, delta_t, time_window=None):
+    """ (first, count) of the time bins of a study of num_timesteps bins overlapping time_window
+
+        time_window = (t_start, t_end) selects the frames with t_start <= time < t_end, either bound may be
+        None or infinite. Without it every bin is kept.
+    """
+    if time_window is None:
+        return 0, num_timesteps
+    t_start, t_end = (np.nan if t is None else t for t in time_window)
+    first = 0 if np.isnan(t_start) else int(np.clip(np.floor(t_start / delta_t), 0, num_timesteps))
+    last = num_timesteps if np.isnan(t_end) else int(np.clip(np.ceil(t_end / delta_t), first, num_timesteps))
+    return first, last - first
 
 
 class GridCollection:
-    def __init__(self, num_repetitions, num_timesteps, x_size, y_size, delta_x, delta_y, x_min, y_min, delta_t):
+    """ All the velocity grids of a study
+
+        Every VelocityGrid field is stored once for the whole collection as an
+        (num_repetitions, num_timesteps, x_size, y_size) array, e.g. self.cn[rep_idx, t_idx], and
+        grid_collection[rep_idx][t_idx] is a VelocityGrid viewing one slice of them. The batched
+        calc_rotor, scale_velocity_field and calc_cn work on the stack in batches of up to
+        max_batch_cells cells, which bounds their temporaries.
+
+        With storage set, the arrays are memory-mapped .npy files in that directory (mode 'w+' creates
+        them), so studies larger than RAM are computed in place and a finished run can be reopened
+        with GridCollection.open(storage) without recomputing anything.
+
+        With time_window = (t_start, t_end), only the time bins overlapping it are held (see window_bins):
+        num_timesteps becomes their number and t_idx counts from the first of them, t_first.
+    """
+    max_batch_cells = 1 << 22
+
+    def __init__(self, num_repetitions, num_timesteps, x_size, y_size, delta_x, delta_y, x_min, y_min, delta_t,
+                 storage=None, mode='w+', time_window=None):
         self.grid_collection = []
         self.in_area = BoolGrid(x_size, y_size, delta_x, delta_y, x_min, y_min)
         self.delta_t = delta_t
+        self.delta_x = float(delta_x)
+        self.delta_y = float(delta_y)
         self.num_repetitions = num_repetitions
-        self.num_timesteps = num_timesteps
+        self.time_window = None if time_window is None else tuple(time_window)
+        self.t_first, self.num_timesteps = window_bins(num_timesteps, delta_t, time_window)
+        self.storage = storage
+        shape = (num_repetitions, self.num_timesteps, int(x_size), int(y_size))
+        self.geometry = {'num_repetitions': num_repetitions, 'num_timesteps': num_timesteps, 'x_size': x_size,
+                         'y_size': y_size, 'delta_x': delta_x, 'delta_y': delta_y, 'x_min': x_min, 'y_min': y_min,
+                         'delta_t': delta_t}  # constructor arguments
+        if time_window is not None:
+            self.geometry['time_window'] = list(time_window)
+        if storage is not None and mode == 'w+':
+            os.makedirs(storage, exist_ok=True)
+            with open(os.path.join(storage, 'grid.json'), 'w') as fp:
+                json.dump(self.geometry, fp)
+        for name, dtype in VelocityGrid.FIELDS:
+            setattr(self, name, self._allocate(name, shape, dtype, mode))
+        self.update_count = self._allocate('update_count', shape[:2], np.int64, mode)  # frames per (rep, t)
+        self.in_area.cell_list = self._allocate('in_area', shape[2:], np.bool_, mode)
         for rep in range(num_repetitions):
             rep_grids = []
-            for tstep in range(num_timesteps):
-                g = VelocityGrid(rep, x_size, y_size, delta_x, delta_y, x_min, y_min)
+            for tstep in range(self.num_timesteps):
+                fields = {name: getattr(self, name)[rep, tstep] for name, _ in VelocityGrid.FIELDS}
+                fields['update_count'] = self.update_count[rep, tstep, ...]  # 0-d view
+                g = VelocityGrid(rep, x_size, y_size, delta_x, delta_y, x_min, y_min, fields=fields)
                 rep_grids.append(g)
             self.grid_collection.append(rep_grids)
 
+    @classmethod
+    def open(cls, storage, mode='r+'):
+        """ Reopens the memory-mapped collection in storage, mode 'r' for read only access """
+        with open(os.path.join(storage, 'grid.json')) as fp:
+            args = json.load(fp)
+        return cls(**args, storage=storage, mode=mode)
+
+    def _allocate(self, name, shape, dtype, mode):
+        if self.storage is None:
+            return np.zeros(shape, dtype=dtype)
+        fname = os.path.join(self.storage, f'{name}.npy')
+        if mode == 'w+':
+            return np.lib.format.open_memmap(fname, mode='w+', dtype=dtype, shape=shape)
+        return np.load(fname, mmap_mode=mode)
+
+    def flush(self):
+        """ Writes the memory-mapped arrays back to storage """
+        if self.storage is None:
+            return
+        for name, _ in VelocityGrid.FIELDS:
+            getattr(self, name).flush()
+        self.update_count.flush()
+        self.in_area.cell_list.flush()
+
+    def _batches(self):
+        """ Slices of the flattened (rep, t) axis holding at most max_batch_cells cells each """
+        step = max(1, self.max_batch_cells // max(1, self.in_area.x_size * self.in_area.y_size))
+        num_grids = self.num_repetitions * self.num_timesteps
+        for start in range(0, num_grids, step):
+            yield slice(start, min(start + step, num_grids))
+
+    def _flat(self, name):  # (rep * t, x, y) view of a field
+        field = getattr(self, name)
+        return field.reshape((-1,) + field.shape[2:])
+
     def valid_idx(self, rep_idx, t_idx):
         valid = True
         if rep_idx < 0 or rep_idx >= len(self.grid_collection):
@@ -188,7 +836,7 @@ class GridCollection:
 
     def update(self, sim, time, ped_state):
         rep_idx = int(sim)
-        t_idx = int(time / self.delta_t)
+        t_idx = int(time / self.delta_t) - self.t_first
         if self.valid_idx(rep_idx, t_idx):
             self.grid_collection[rep_idx][t_idx].update_velocity_field(ped_state)
         else:
@@ -197,82 +845,471 @@ class GridCollection:
     def write_velocity(self):
         for rep_idx in range(self.num_repetitions):
             for t_idx in range(self.num_timesteps):
-                fname = f'data/TEST_R_{rep_idx}_T_{t_idx}'
+                fname = f'data/TEST_R_{rep_idx}_T_{self.t_first + t_idx}_v'
                 grid = self.grid_collection[rep_idx][t_idx]
                 grid.write_to_file_v(fname)
 
     def write_rotor(self):
         for rep_idx in range(self.num_repetitions):
             for t_idx in range(self.num_timesteps):
-                fname = f'data/TEST_R_{rep_idx}_T_{t_idx}'
+                fname = f'data/TEST_R_{rep_idx}_T_{self.t_first + t_idx}_rot'
                 grid = self.grid_collection[rep_idx][t_idx]
                 grid.write_to_file(fname, attribute="rot")
 
     def write_cn(self):
         for rep_idx in range(self.num_repetitions):
             for t_idx in range(self.num_timesteps):
-                fname = f'data/TEST_R_{rep_idx}_T_{t_idx}'
+                fname = f'data/TEST_R_{rep_idx}_T_{self.t_first + t_idx}_cn'
                 grid = self.grid_collection[rep_idx][t_idx]
                 grid.write_to_file(fname, attribute="cn")
 
-    def calc_rotor(self):
+    def write_fields(self, fname, compress=True, cn_exact=None):
+        """ Writes every grid of the collection to a single .npz file, see load_fields
+
+            Datasets: v (R, T, X, Y, 2), rot, rotval, cn, dens (R, T, X, Y), in_area (X, Y) and the
+            grid geometry as scalars, t_first being the time bin of the study the first of the T is. Arrays
+            are written one grid at a time, without a full copy.
+            cn_exact, the mask returned by calc_cn_adaptive, is written as cn_exact (R, T, X, Y).
+        """
+        grids = list(itertools.product(range(self.num_repetitions), range(self.num_timesteps)))
+        datasets = {
+            'v': (np.stack((self.vx[idx], self.vy[idx]), axis=-1) for idx in grids),
+            'rot': (self.rot[idx] for idx in grids), 'rotval': (self.rotval[idx] for idx in grids),
+            'cn': (self.cn[idx] for idx in grids), 'dens': (self.dens[idx] for idx in grids)
+        }
+        if cn_exact is not None:
+            datasets['cn_exact'] = (cn_exact[idx] for idx in grids)
+        geometry = {'x_min': self.in_area.x_min, 'y_min': self.in_area.y_min, 'delta_x': self.delta_x,
+                    'delta_y': self.delta_y, 'delta_t': float(self.delta_t), 't_first': self.t_first}
+        with zipfile.ZipFile(fname, 'w', compression=zipfile.ZIP_DEFLATED if compress else zipfile.ZIP_STORED,
+                             allowZip64=True) as zf:
+            for name, chunks in datasets.items():
+                _write_npz_member(zf, name, chunks, (self.num_repetitions, self.num_timesteps))
+            _write_npz_member(zf, 'in_area', [self.in_area.cell_list])
+            for name, value in geometry.items():
+                _write_npz_member(zf, name, [value])
+
+    def calc_rotor(self, batched=True, tile=None, workers=None):
+        """ With tile, each batch is split in tile x tile spatial blocks processed by workers threads """
+        if batched:
+            vx, vy, dens, rot, rotval = (self._flat(name) for name in ('vx', 'vy', 'dens', 'rot', 'rotval'))
+            for b in self._batches():
+                if tile:
+                    calc_rotor_field_tiled(vx[b], vy[b], dens[b], rot[b], rotval[b], self.delta_x, tile, workers)
+                else:
+                    calc_rotor_field(vx[b], vy[b], dens[b], rot[b], rotval[b], self.delta_x)
+            return
         for rep_idx in range(self.num_repetitions):
             for t_idx in range(self.num_timesteps):
                 grid = self.grid_collection[rep_idx][t_idx]
-                grid.calc_rotor()
+                grid.calc_rotor(tile, workers)
 
-    def scale_velocity_field(self):
+    def scale_velocity_field(self, batched=True):
+        if batched:
+            vx, vy, dens = (self._flat(name) for name in ('vx', 'vy', 'dens'))
+            update_count = self.update_count.reshape(-1)
+            for b in self._batches():
+                in_area = scale_velocity(vx[b], vy[b], dens[b], update_count[b], self.delta_x, self.delta_y)
+                self.in_area.cell_list |= in_area.any(axis=0)
+            return
         for rep_idx in range(self.num_repetitions):
             for t_idx in range(self.num_timesteps):
                 grid = self.grid_collection[rep_idx][t_idx]
                 grid.scale_velocity_field(self.in_area)
 
-    def calc_cn(self, cn_radius):
+    def calc_cn(self, cn_radius, batched=True, tile=None, workers=None):
+        """ With tile, each batch is split in tile x tile spatial blocks processed by workers threads """
+        if batched:
+            vx, vy, rot, rotval, cn = (self._flat(name) for name in ('vx', 'vy', 'rot', 'rotval', 'cn'))
+            for b in self._batches():
+                if tile:
+                    cn[b] = calc_cn_field_tiled(vx[b], vy[b], rot[b], rotval[b], cn_radius, self.delta_x, tile,
+                                                workers)
+                else:
+                    cn[b] = calc_cn_field(vx[b], vy[b], rot[b], rotval[b], cn_radius, self.delta_x)
+            return
         for rep_idx in range(self.num_repetitions):
             for t_idx in range(self.num_timesteps):
                 grid = self.grid_collection[rep_idx][t_idx]
-                grid.calc_cn(cn_radius)
+                grid.calc_cn(cn_radius, tile=tile, workers=workers)
+
+    def calc_cn_adaptive(self, cn_radius, threshold, block=32):
+        """ Exact CN only where it may exceed threshold, see calc_cn_field_adaptive
+
+            self.cn holds the bound of the blocks left unrefined, returns the (R, T, X, Y) mask of the
+            cells holding an exact value, memory-mapped as cn_exact.npy with storage set.
+        """
+        vx, vy, rot, rotval, cn = (self._flat(name) for name in ('vx', 'vy', 'rot', 'rotval', 'cn'))
+        exact = self._allocate('cn_exact', self.cn.shape, np.bool_, 'w+')
+        flat_exact = exact.reshape(cn.shape)
+        for b in self._batches():
+            cn[b], flat_exact[b] = calc_cn_field_adaptive(vx[b], vy[b], rot[b], rotval[b], cn_radius, self.delta_x,
+                                                          threshold, block)
+        return exact
+
+    def calc_cn_sweep(self, radii):
+        """ CN of every grid for each of radii, as {radius: (R, T, X, Y) array}, leaving self.cn untouched
+
+            With storage set, the arrays are memory-mapped as cn_r_<radius>.npy.
+        """
+        cn = {radius: self._allocate(f'cn_r_{radius:g}', self.cn.shape, np.float64, 'w+') for radius in radii}
+        vx, vy, rot, rotval = (self._flat(name) for name in ('vx', 'vy', 'rot', 'rotval'))
+        for b in self._batches():
+            for radius, cn_batch in calc_cn_sweep_field(vx[b], vy[b], rot[b], rotval[b], radii,
+                                                        self.delta_x).items():
+                cn[radius].reshape(vx.shape)[b] = cn_batch
+        return cn
+
+    def up_all(self, rep_idx, time):  # counts a frame of repetition rep_idx
+        t_idx = int(time / self.delta_t) - self.t_first
+        if self.valid_idx(rep_idx, t_idx):
+            self.update_count[rep_idx, t_idx] += 1
+
+    def add_frames(self, rep_idx, block):
+        """ Bins a FrameBlock of repetition rep_idx, the bulk counterpart of up_all + update """
+        t_idx = (block.times / self.delta_t).astype(np.int64) - self.t_first
+        valid_t = (t_idx >= 0) & (t_idx < self.num_timesteps)
+        self.update_count[rep_idx] += np.bincount(t_idx[valid_t], minlength=self.num_timesteps)
+
+        ped_t = np.repeat(t_idx, block.counts)
+        ped_valid_t = np.repeat(valid_t, block.counts)
+        for time in np.repeat(block.times, block.counts)[~ped_valid_t].tolist():
+            print(f" Ignoring pedestrian from rep:{rep_idx}, time:{time}")
+        grid = self.grid_collection[rep_idx][0]
+        x_idx, y_idx, valid = grid.cell_idx(block.x, block.y)
+        for x, y in zip(block.x[ped_valid_t & ~valid].tolist(), block.y[ped_valid_t & ~valid].tolist()):
+            print(f" Ignoring pedestrian at x: {x},y: {y}, rep: {rep_idx}")
+        valid &= ped_valid_t
+        idx = (ped_t[valid], x_idx[valid], y_idx[valid])
+        np.add.at(self.vx[rep_idx], idx, block.vx[valid])
+        np.add.at(self.vy[rep_idx], idx, block.vy[valid])
+        np.add.at(self.dens[rep_idx], idx, 1)
+
+    def add_pedestrians(self, rep_idx, t_idx, x, y, vx, vy):
+        """ Bins pedestrians given with their repetition and time bin (arrays or scalars)
+
+            Unlike add_frames, the frames are not counted (see update_count) and the pedestrians outside
+            the grid or the study are dropped silently. Returns the mask of the binned pedestrians.
+        """
+        x_idx, y_idx, valid = self.grid_collection[0][0].cell_idx(x, y)
+        rep_idx, t_idx = np.broadcast_to(rep_idx, valid.shape), np.broadcast_to(t_idx, valid.shape)
+        valid &= (rep_idx >= 0) & (rep_idx < self.num_repetitions) & (t_idx >= 0) & (t_idx < self.num_timesteps)
+        idx = (rep_idx[valid], t_idx[valid], x_idx[valid], y_idx[valid])
+        np.add.at(self.vx, idx, vx[valid])
+        np.add.at(self.vy, idx, vy[valid])
+        np.add.at(self.dens, idx, 1)
+        return valid
+
+    def init_velocity_field(self, positions_dir='positions', prefetch=0, binary=False):
+        """ Bins the frames of every repetition within time_window, see positions_files and read_positions """
+        for rep_idx, block in read_positions(positions_files(positions_dir, self.num_repetitions, binary), prefetch,
+                                             time_window=self.time_window):
+            self.add_frames(rep_idx, block)
+
+
+def _write_npz_member(zf, name, chunks, stack_shape=()):
+    """ Writes the chunks of an iterable, stacked into stack_shape, as name.npy of an open npz
+
+        stack_shape is the shape the chunks are laid out in, () for a single chunk. The chunks are
+        consumed and written one at a time, each being a same shaped array.
+    """
+    chunks = iter(chunks)
+    first = np.asarray(next(chunks))
+    header = {'descr': np.lib.format.dtype_to_descr(first.dtype), 'fortran_order': False,
+              'shape': tuple(stack_shape) + first.shape}
+    with zf.open(name + '.npy', 'w', force_zip64=True) as fp:
+        np.lib.format.write_array_header_2_0(fp, header)
+        for chunk in itertools.chain([first], chunks):
+            fp.write(np.ascontiguousarray(chunk, dtype=first.dtype).tobytes())  # C order, as declared
+
+
+def load_fields(fname):
+    """ Opens a GridCollection.write_fields file, each dataset is read when first accessed: fields['cn'] """
+    return np.load(fname)
+
+
+class StreamingGridCollection:
+    """ Constant memory alternative to GridCollection + Statistics.calc_statistics
+
+        Only one VelocityGrid is kept: each time bin of positions/pos_{rep}.dat is binned, scaled, its
+        rotor, CN and statistics computed, then the grid is cleared for the next bin. Peak memory is
+        O(x_size * y_size) plus the statistics. The statistics need in_area, the cells occupied anywhere in
+        the study, so run first makes a cheap occupancy pass over the files. Frames must be in
+        non-decreasing time order. With tile set, the grid is a SparseVelocityGrid of tile x tile cell
+        tiles, for mostly empty spaces. With spatial_tile set instead, the rotor and CN of the dense grid
+        are computed on spatial_tile x spatial_tile blocks by threads threads, for large areas. With
+        prefetch > 0, a background thread reads the files up to prefetch blocks ahead of the binning,
+        moving on to the next repetition's file while the last bins of the current one are computed.
+        time_window = (t_start, t_end) restricts the study to the frames with t_start <= time < t_end and
+        to the time bins overlapping it, as for GridCollection: only those are computed and reported.
+        timings sums the wall time and items (frames, grids) of the ingest, scale, rotor, cn and statistics
+        stages over the bins, ingest being the reading and binning of the files.
+    """
+    def __init__(self, num_repetitions, num_timesteps, x_size, y_size, delta_x, delta_y, x_min, y_min, delta_t,
+                 tile=None, spatial_tile=None, threads=None, prefetch=0, time_window=None):
+        if tile and spatial_tile:
+            raise ValueError("tile and spatial_tile are exclusive")
+        self.in_area = BoolGrid(x_size, y_size, delta_x, delta_y, x_min, y_min)
+        self.delta_t = delta_t
+        self.num_repetitions = num_repetitions
+        self.t_first, self.num_timesteps = window_bins(num_timesteps, delta_t, time_window)
+        if tile:
+            self.grid = SparseVelocityGrid(0, x_size, y_size, delta_x, delta_y, x_min, y_min, tile=tile)
+        else:
+            self.grid = VelocityGrid(0, x_size, y_size, delta_x, delta_y, x_min, y_min)
+        self.in_area_count = None  # cells of in_area, once scanned
+        self.spatial_tile = spatial_tile
+        self.threads = threads
+        self.prefetch = prefetch
+        self.time_window = time_window
+        self.timings = {}  # {stage: [seconds, items]}
+
+    def _add_timing(self, stage, elapsed, items):
+        timing = self.timings.setdefault(stage, [0.0, 0])
+        timing[0] += elapsed
+        timing[1] += items
+
+    def _merge_timings(self, timings):  # adds the timings of a process pool task
+        for stage, (elapsed, items) in timings.items():
+            self._add_timing(stage, elapsed, items)
+
+    def _blocks(self, fname):
+        return (block for _, block in read_positions([fname], self.prefetch, time_window=self.time_window))
+
+    def _blocks_by_file(self, fnames):  # FrameBlocks of each of fnames, from a single prefetching reader
+        return blocks_by_file(read_positions(fnames, self.prefetch, time_window=self.time_window), len(fnames))
+
+    def scan_occupancy(self, rep_idx, fname, blocks=None):
+        """ Marks the cells occupied in the positions file fname in in_area, blocks being its FrameBlocks if read """
+        start = time.perf_counter()
+        for block in self._blocks(fname) if blocks is None else blocks:
+            t_idx = (block.times / self.delta_t).astype(np.int64) - self.t_first
+            valid_t = np.repeat((t_idx >= 0) & (t_idx < self.num_timesteps), block.counts)
+            x_idx, y_idx, valid = self.grid.cell_idx(block.x, block.y)
+            valid &= valid_t
+            self.in_area.cell_list[x_idx[valid], y_idx[valid]] = True
+        self._add_timing('ingest', time.perf_counter() - start, 0)  # the frames are counted once, when binned
 
-    # TODO
-    def up_all(self, rep_idx, time):
+    def _close_bin(self, rep_idx, t_idx, cn_radius, stats):  # returns the seconds spent in its timed stages
+        grid = self.grid
+        sparse = isinstance(grid, SparseVelocityGrid)
+        start = time.perf_counter()
+        grid.scale_velocity_field(self.in_area)
+        scaled = time.perf_counter()
+        if sparse:
+            grid.calc_rotor()
+        else:
+            grid.calc_rotor(self.spatial_tile, self.threads)
+        rotor = time.perf_counter()
+        if sparse:
+            grid.calc_cn(cn_radius)
+        else:
+            grid.calc_cn(cn_radius, tile=self.spatial_tile, workers=self.threads)
+        cn = time.perf_counter()
+        if sparse:
+            if self.in_area_count is None:
+                self.in_area_count = np.count_nonzero(self.in_area.cell_list)
+            stats.update_sparse_grid(rep_idx, t_idx, grid, self.in_area, self.in_area_count)
+        else:
+            stats.update_grid(rep_idx, t_idx, grid, self.in_area)
+        done = time.perf_counter()
+        for stage, elapsed in (('scale', scaled - start), ('rotor', rotor - scaled), ('cn', cn - rotor),
+                               ('statistics', done - cn)):
+            self._add_timing(stage, elapsed, 1)
+        grid.clear()
+        return done - start
+
+    def process_repetition(self, rep_idx, fname, cn_radius, stats, stats_row=None, blocks=None):
+        """ Streams one positions file into row stats_row (rep_idx by default) of stats, see scan_occupancy """
+        stats_row = rep_idx if stats_row is None else stats_row
+        start = time.perf_counter()
+        computed = 0.0  # seconds in _close_bin, the rest is ingest
+        num_frames = 0
+        grid = self.grid
+        grid.rep_id = rep_idx
+        grid.clear()
+        t_cur = 0
+        for block in self._blocks(fname) if blocks is None else blocks:
+            t_idx = (block.times / self.delta_t).astype(np.int64) - self.t_first
+            offsets = np.concatenate(([0], np.cumsum(block.counts)))
+            valid_t = (t_idx >= 0) & (t_idx < self.num_timesteps)
+            ped_valid_t = np.repeat(valid_t, block.counts)
+            for frame_time in np.repeat(block.times, block.counts)[~ped_valid_t].tolist():
+                print(f" Ignoring pedestrian from rep:{rep_idx}, time:{frame_time}")
+            frames = np.flatnonzero(valid_t)
+            num_frames += frames.size
+            if frames.size == 0:
+                continue
+            if t_idx[frames[0]] < t_cur or np.any(np.diff(t_idx[frames]) < 0):
+                raise ValueError(f"{fname}: frames are not in time order")
+            # runs of consecutive frames falling into the same time bin
+            runs = np.split(frames, np.flatnonzero(np.diff(t_idx[frames])) + 1)
+            for run in runs:
+                t_idx_run = t_idx[run[0]]
+                while t_cur < t_idx_run:
+                    computed += self._close_bin(stats_row, t_cur, cn_radius, stats)
+                    t_cur += 1
+                grid.update_count += run.size
+                peds = slice(offsets[run[0]], offsets[run[-1] + 1])
+                keep = ped_valid_t[peds]
+                grid.add_pedestrians(block.x[peds][keep], block.y[peds][keep], block.vx[peds][keep],
+                                     block.vy[peds][keep])
+        while t_cur < self.num_timesteps:
+            computed += self._close_bin(stats_row, t_cur, cn_radius, stats)
+            t_cur += 1
+        self._add_timing('ingest', time.perf_counter() - start - computed, num_frames)
+
+    def run(self, cn_radius, positions_dir='positions', workers=1, binary=False):
+        """ Statistics of the whole study, with workers > 1 repetitions are spread over a process pool
+
+            Each worker returns the in_area of its repetition, then, once those are merged, its rows of
+            the per-(rep, t) statistics, with its timings. binary selects the positions files, see positions_files.
+        """
+        reps = range(self.num_repetitions)
+        fnames = positions_files(positions_dir, self.num_repetitions, binary)
+        stats = Statistics(self)
+        if workers > 1:
+            with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+                for in_area, timings in pool.map(_scan_repetition, itertools.repeat(self), reps, fnames):
+                    self.in_area.cell_list |= in_area
+                    self._merge_timings(timings)
+                for rep_idx, (rows, timings) in zip(reps, pool.map(_stream_repetition, itertools.repeat(self), reps,
+                                                                   fnames, itertools.repeat(cn_radius))):
+                    stats.set_repetition(rep_idx, rows)
+                    self._merge_timings(timings)
+        else:
+            for rep_idx, fname, blocks in zip(reps, fnames, self._blocks_by_file(fnames)):
+                self.scan_occupancy(rep_idx, fname, blocks)
+            for rep_idx, fname, blocks in zip(reps, fnames, self._blocks_by_file(fnames)):
+                self.process_repetition(rep_idx, fname, cn_radius, stats, blocks=blocks)
+        stats.finalize()
+        return stats
+
+
+def _scan_repetition(sgc, rep_idx, fname):  # pool task, in_area and timings of one repetition
+    sgc.timings = {}  # the copy holds those of the parent
+    sgc.scan_occupancy(rep_idx, fname)
+    return sgc.in_area.cell_list, sgc.timings
+
+
+def _stream_repetition(sgc, rep_idx, fname, cn_radius):  # pool task, statistics rows and timings of one repetition
+    sgc.timings = {}
+    stats = Statistics(sgc, num_repetitions=1)
+    sgc.process_repetition(rep_idx, fname, cn_radius, stats, stats_row=0)
+    return stats.repetition(0), sgc.timings
+
+
+OnlineBin = collections.namedtuple('OnlineBin', ['t_idx', 'window', 'cn', 'stats'])
+OnlineBin.__doc__ = """ A closed time bin of OnlineGridCollection: cn holds the CN of the cells window, a pair of
+    slices of the grid, and is zero elsewhere. stats maps the Statistics.FIELDS to finalized 0-d StatsArrays """
+
+
+class OnlineGridCollection:
+    """ Congestion numbers of a live feed, one time bin at a time
+
+        push bins the pedestrians of each frame into a single VelocityGrid. When a frame falls into a
+        later time bin, the current one is closed: only the box of cells occupied during the bin,
+        dilated by the CN neighbourhood, is scaled, its rotor and CN computed and then cleared, as the
+        CN is zero everywhere else. A frame thus costs O(pedestrians) and a bin close O(box) instead
+        of O(x_size * y_size). in_area grows with the cells occupied so far, so av_in_cn and dens
+        are averaged over the area seen up to the closed bin rather than over the whole study.
+        Pedestrians outside the grid are reported on stderr, leaving stdout to the bin summaries.
+    """
+    def __init__(self, x_size, y_size, delta_x, delta_y, x_min, y_min, delta_t, cn_radius, rep_idx=0):
+        self.in_area = BoolGrid(x_size, y_size, delta_x, delta_y, x_min, y_min)
+        self.in_area_count = 0  # cells of in_area
+        self.delta_t = delta_t
+        self.cn_radius = cn_radius
+        self.grid = VelocityGrid(rep_idx, x_size, y_size, delta_x, delta_y, x_min, y_min)
+        self.t_idx = None  # current bin
+        self.frames = 0  # frames in the current bin
+        self.box = None  # [x_lo, y_lo, x_hi, y_hi) of the cells occupied in the current bin
+
+    def push(self, time, positions, velocities):
+        """ Adds a frame of (n, 2) positions and velocities, returns the OnlineBins it closes """
         t_idx = int(time / self.delta_t)
-        if t_idx < self.num_timesteps:
-            grid = self.grid_collection[rep_idx][t_idx]
-            for i in range(grid.x_size):
-                for j in range(grid.y_size):
-                    grid[i][j].update_count += 1
+        if self.t_idx is None:
+            self.t_idx = t_idx
+        if t_idx < self.t_idx:
+            raise ValueError(f"frame at time {time} is older than the current time bin")
+        closed = []
+        while self.t_idx < t_idx:
+            closed.append(self._close_bin())
+        positions = np.asarray(positions, dtype=np.float64).reshape(-1, 2)
+        velocities = np.asarray(velocities, dtype=np.float64).reshape(-1, 2)
+        self.frames += 1
+        x_idx, y_idx, valid = self.grid.cell_idx(positions[:, 0], positions[:, 1])
+        for ped_x, ped_y in positions[~valid].tolist():
+            print(f" Ignoring pedestrian at x: {ped_x},y: {ped_y}, rep: {self.grid.rep_id}", file=sys.stderr)
+        if valid.any():
+            box = (x_idx[valid].min(), y_idx[valid].min(), x_idx[valid].max() + 1, y_idx[valid].max() + 1)
+            if self.box is not None:
+                box = (min(box[0], self.box[0]), min(box[1], self.box[1]), max(box[2], self.box[2]),
+                       max(box[3], self.box[3]))
+            self.box = box
+        self.grid.add_pedestrians(positions[valid, 0], positions[valid, 1], velocities[valid, 0], velocities[valid, 1])
+        return closed
 
-    def init_velocity_field(self):
-        for rep_idx in range(self.num_repetitions):
-            fname = f'positions/pos_{rep_idx}.dat'
-            with open(fname) as fp:
-                line = fp.readline()
-                while line:
-                    time, ped_count = line.strip().split(' ')
-                    time = float(time)
-                    self.up_all(rep_idx, time)
-                    ped_count = int(ped_count)
-                    line = fp.readline().strip().split(' ')
-                    if ped_count:
-                        for i in range(ped_count):
-                            idx = i * 4
-                            x = float(line[idx])
-                            y = float(line[idx + 1])
-                            vx = float(line[idx + 2])
-                            vy = float(line[idx + 3])
-                            ped_state = {
-                                'x': x,
-                                'y': y,
-                                'v': Vec2D(vx, vy)
-                            }
-                            self.update(rep_idx, time, ped_state)
-                    line = fp.readline()
+    def flush(self):
+        """ Closes the current time bin at the end of the feed, returns its OnlineBin or None """
+        if self.t_idx is None:
+            return None
+        return self._close_bin()
+
+    def _window(self, margin):  # self.box dilated by margin cells, within the grid
+        x_lo, y_lo, x_hi, y_hi = self.box
+        return (slice(max(0, x_lo - margin), min(self.grid.x_size, x_hi + margin)),
+                slice(max(0, y_lo - margin), min(self.grid.y_size, y_hi + margin)))
+
+    def _close_bin(self):
+        grid = self.grid
+        stats = {name: StatsArray(()) for name in Statistics.FIELDS}
+        if self.box is None:  # nobody in the bin, the CN is zero everywhere
+            window = (slice(0, 0), slice(0, 0))
+            cn = np.zeros((0, 0))
+        else:
+            occupied = self._window(0)
+            in_area = scale_velocity(grid.vx[occupied], grid.vy[occupied], grid.dens[occupied], self.frames,
+                                     grid.delta_x, grid.delta_y)
+            self.in_area_count += np.count_nonzero(in_area & ~self.in_area.cell_list[occupied])
+            self.in_area.cell_list[occupied] |= in_area
+            # the rotor needs the 4-neighbours of the box, the CN is zero beyond its neighbourhood
+            rotor = self._window(1)
+            calc_rotor_field(grid.vx[rotor], grid.vy[rotor], grid.dens[rotor], grid.rot[rotor], grid.rotval[rotor],
+                             grid.delta_x)
+            window = self._window(int(self.cn_radius) + 1)
+            cn = calc_cn_field(grid.vx[window], grid.vy[window], grid.rot[window], grid.rotval[window],
+                               self.cn_radius, grid.delta_x)
+            window_area = self.in_area.cell_list[window]
+            stats['av_cn'].update(Ellipsis, cn.reshape(-1), cn.reshape(-1) > 0)
+            stats['max_cn'].av[...] = cn.max(initial=0)
+            stats['dens'].update(Ellipsis, grid.dens[window][window_area])
+            stats['av_in_cn'].update(Ellipsis, cn[window_area])
+            for name, _ in VelocityGrid.FIELDS:
+                getattr(grid, name)[window] = 0
+        outside = StatsArray(())  # in_area cells outside the window, where dens and cn are zero
+        outside.conta[...] = self.in_area_count - np.count_nonzero(self.in_area.cell_list[window])
+        for name in ('dens', 'av_in_cn'):
+            stats[name].merge(outside)
+        for name in ('av_cn', 'dens', 'av_in_cn'):
+            stats[name].finalize()
+        closed = OnlineBin(self.t_idx, window, cn, stats)
+        self.t_idx += 1
+        self.frames = 0
+        self.box = None
+        return closed
 
 
 class Params:
-    def __init__(self):
+    def __init__(self, fname='parameters'):
         self.params = {}
-        self.read()
+        self.read(fname)
+
+    def grid_args(self):
+        """ Positional arguments of GridCollection and StreamingGridCollection """
+        p = self.params
+        return (int(p['num_repetitions']), int(p['num_timesteps']), p['x_size'], p['y_size'], p['delta_x'],
+                p['delta_y'], p['x_min'], p['y_min'], p['delta_t'])
 
     def read(self, fname='parameters'):
         with open(fname) as fp:
@@ -283,93 +1320,240 @@ class Params:
                 line = fp.readline()
 
 
-class StatsCell:  # for statistics
-    def __init__(self):
-        self.conta = 0  # counter
-        self.av = 0  # average
-        self.sg = 0  # standard dev
-        self.er = 0  # std err
-
-    def update(self, up):
-        self.av += up
-        self.sg += up * up
-        self.conta += 1
-
-    def finalize(self):  # computes everything
-        if (self.conta):
-            self.av /= self.conta
-            self.sg /= self.conta
-
-        if (self.conta > 1):
-            self.sg = math.sqrt(self.sg - self.av ** 2)
-            self.er = self.sg / math.sqrt(self.conta - 1)
+class StatsArray:  # for statistics, e.g. one cell per (rep, t)
+    """ Running means and standard deviations, numerically stable and mergeable
+
+        While accumulating, av is the running mean and sg the sum of squared deviations from it (Welford),
+        so the variance cannot go negative through cancellation. merge combines two partial arrays exactly
+        (Chan et al.), e.g. a tile's statistics with those of the cells outside it. finalize turns sg into
+        the standard deviation and er into the standard error.
+    """
+    FIELDS = ('conta', 'av', 'sg', 'er')
+
+    def __init__(self, shape):
+        self.conta = np.zeros(shape, dtype=np.int64)  # counter
+        self.av = np.zeros(shape)  # average
+        self.sg = np.zeros(shape)  # standard dev
+        self.er = np.zeros(shape)  # std err
+
+    def __getitem__(self, idx):  # StatsArray of a subset of the cells
+        sub = StatsArray(())
+        for name in self.FIELDS:
+            setattr(sub, name, getattr(self, name)[idx])
+        return sub
+
+    def __setitem__(self, idx, other):
+        for name in self.FIELDS:
+            getattr(self, name)[idx] = getattr(other, name)
+
+    def update(self, idx, values, mask=None):
+        """ Adds to the cells idx each value along the last axis of values (where mask)
+
+            The values are reduced to their count, mean and sum of squared deviations, then merged in.
+        """
+        if mask is None:
+            conta = np.full(values.shape[:-1], values.shape[-1], dtype=np.int64)
+            total = values.sum(axis=-1)
         else:
-            self.sg = 0
-            self.er = 0
+            conta = mask.sum(axis=-1)
+            total = np.where(mask, values, 0.0).sum(axis=-1)
+        av = total / np.maximum(conta, 1)
+        deviation = values - av[..., np.newaxis]
+        if mask is not None:
+            deviation = np.where(mask, deviation, 0.0)
+        self._merge(idx, conta, av, (deviation * deviation).sum(axis=-1))
+
+    def merge(self, other, idx=Ellipsis):  # adds the values accumulated by the cells of other to the cells idx
+        self._merge(idx, other.conta, other.av, other.sg)
+
+    def _merge(self, idx, conta_b, av_b, sg_b):
+        conta_a = self.conta[idx]
+        conta = conta_a + conta_b
+        n = np.maximum(conta, 1)
+        av_a = self.av[idx]
+        delta = av_b - av_a
+        self.av[idx] = np.where(conta_b > 0, av_a + delta * conta_b / n, av_a)
+        self.sg[idx] = np.where(conta_b > 0, self.sg[idx] + sg_b + delta * delta * conta_a * conta_b / n,
+                                self.sg[idx])
+        self.conta[idx] = conta
+
+    def finalize(self, idx=Ellipsis):  # computes everything for the cells idx
+        conta = self.conta[idx]
+        sg = np.sqrt(self.sg[idx] / np.maximum(conta, 1))
+        self.sg[idx] = np.where(conta > 1, sg, 0)
+        self.er[idx] = np.where(conta > 1, sg / np.sqrt(np.maximum(conta - 1, 1)), 0)
 
 
 class DDistr:  # includes a vector and a matrix for statistics
-    def __init__(self, r, num_timesteps, dt):  # intialises giving # of reps, maximum time and time step
+    def __init__(self, r, num_timesteps, dt, t_first=0):  # # of reps, time steps from bin t_first and time step
         self.repetition = r
         self.delta_t = dt
         self.delta_t_2 = self.delta_t * 0.5
         self.time_steps = num_timesteps
-        self.d = [StatsCell() for i in range(self.time_steps)]
-        self.dd = []
+        self.t_first = t_first
+        self.d = StatsArray(self.time_steps)
+        self.dd = StatsArray((self.repetition, self.time_steps))
         self.imr = 0
         self.imt = 0
-        for i in range(self.repetition):
-            self.dd.append([StatsCell() for j in range(self.time_steps)])
         self.max_val = -1e10  # very negative max initialisation
 
-    def update(self, up, r, t):  # adds up to the statistics
-        it = int(t / self.delta_t)
-        self.dd[r][it].update(up)
+    def update(self, up, r, t):  # adds up to the statistics, t being the time of the study
+        it = int(t / self.delta_t) - self.t_first
+        self.dd.update((r, it), np.array([up]))
 
     def finalize(self):  # finalises
-        for t in range(self.time_steps):
-            for r in range(self.repetition):
-                if self.dd[r][t].av > self.max_val:  # //finds max
-                    self.max_val = self.dd[r][t].av
-                    self.imr = r
-                    self.imt = t
-                self.d[t].update(self.dd[r][t].av)  # puts in vector the average over reps
-            self.d[t].finalize()  # stats over reps, now in d we have av,sg, and er over reps depending on time
+        by_time = self.dd.av.T  # scanned t first, then r
+        if by_time.size:
+            k = int(np.argmax(by_time))  # //finds max, first one on ties
+            if by_time.flat[k] > self.max_val:
+                self.max_val = by_time.flat[k].item()
+                self.imt, self.imr = divmod(k, self.repetition)
+        self.d.update(Ellipsis, by_time)  # puts in vector the average over reps
+        self.d.finalize()  # stats over reps, now in d we have av,sg, and er over reps depending on time
 
     def write_to_file(self, fname):
+        av = self.d.av.tolist()
+        er = self.d.er.tolist()
         with open(fname, 'w') as fp:
             for i in range(self.time_steps):
-                ostring = f"{i * self.delta_t + self.delta_t_2:.5f} {self.d[i].av - self.d[i].er:.5f} {self.d[i].av:.5f} {self.d[i].av + self.d[i].er:.5f}\n"
+                time = (self.t_first + i) * self.delta_t + self.delta_t_2
+                ostring = f"{time:.5f} {av[i] - er[i]:.5f} {av[i]:.5f} {av[i] + er[i]:.5f}\n"
                 fp.write(ostring)
 
 
+def calc_sweep_statistics(gc, radii):
+    """ Statistics of gc for each CN radius, as {radius: Statistics}, see GridCollection.calc_cn_sweep """
+    sweep = {}
+    for radius, cn in gc.calc_cn_sweep(radii).items():
+        sweep[radius] = Statistics(gc)
+        sweep[radius].calc_statistics(cn)
+    return sweep
+
+
 class Statistics:
-    def __init__(self, gc):
+    FIELDS = ('av_cn', 'max_cn', 'av_in_cn', 'dens')
+
+    def __init__(self, gc, num_repetitions=None):  # num_repetitions overrides the number of rows of gc
         self.gc = gc
-        self.av_cn = DDistr(gc.num_repetitions, gc.num_timesteps, gc.delta_t)
-        self.max_cn = DDistr(gc.num_repetitions, gc.num_timesteps, gc.delta_t)
-        self.av_in_cn = DDistr(gc.num_repetitions, gc.num_timesteps, gc.delta_t)
-        self.dens = DDistr(gc.num_repetitions, gc.num_timesteps, gc.delta_t)
-
-    def calc_statistics(self):
-        for rep_idx in range(self.gc.num_repetitions):
-            for t_idx in range(self.gc.num_timesteps):
-                loc_max = 0
-                grid = self.gc.grid_collection[rep_idx][t_idx]
-                for i in range(grid.x_size):
-                    for j in range(grid.y_size):
-                        if grid[i][j].cn > 0:
-                            self.av_cn.dd[rep_idx][t_idx].update(grid[i][j].cn)
-                            if grid[i][j].cn > loc_max:
-                                loc_max = grid[i][j].cn
-                        if self.gc.in_area[i][j]:
-                            self.dens.dd[rep_idx][t_idx].update(grid[i][j].dens)
-                            self.av_in_cn.dd[rep_idx][t_idx].update(grid[i][j].cn)
-                self.dens.dd[rep_idx][t_idx].finalize()
-                self.av_cn.dd[rep_idx][t_idx].finalize()
-                self.max_cn.dd[rep_idx][t_idx].av = loc_max
-                self.av_in_cn.dd[rep_idx][t_idx].finalize()
+        num_repetitions = gc.num_repetitions if num_repetitions is None else num_repetitions
+        self.av_cn = DDistr(num_repetitions, gc.num_timesteps, gc.delta_t, gc.t_first)
+        self.max_cn = DDistr(num_repetitions, gc.num_timesteps, gc.delta_t, gc.t_first)
+        self.av_in_cn = DDistr(num_repetitions, gc.num_timesteps, gc.delta_t, gc.t_first)
+        self.dens = DDistr(num_repetitions, gc.num_timesteps, gc.delta_t, gc.t_first)
+
+    def repetition(self, rep_idx):  # per-(rep, t) StatsArrays of one repetition
+        return {name: getattr(self, name).dd[rep_idx] for name in self.FIELDS}
+
+    def set_repetition(self, rep_idx, rows):
+        for name in self.FIELDS:
+            getattr(self, name).dd[rep_idx] = rows[name]
+
+    def write_to_files(self, out_dir='.'):
+        for name in self.FIELDS:
+            getattr(self, name).write_to_file(os.path.join(out_dir, f'{name}.dat'))
+
+    def to_dict(self):  # the content of the write_to_files files, {name: {'time': [...], 'av': [...], 'er': [...]}}
+        time = [(self.av_cn.t_first + i) * self.av_cn.delta_t + self.av_cn.delta_t_2
+                for i in range(self.av_cn.time_steps)]
+        return {name: {'time': time, 'av': getattr(self, name).d.av.tolist(), 'er': getattr(self, name).d.er.tolist()}
+                for name in self.FIELDS}
+
+    def calc_statistics(self, cn=None):  # cn: (R, T, X, Y) array used instead of the grids' own cn
+        gc = self.gc
+        cn = gc.cn if cn is None else cn
+        shape = cn.shape
+        cn = cn.reshape(shape[0] * shape[1], -1)
+        dens = gc.dens.reshape(cn.shape)
+        in_area = gc.in_area.cell_list.reshape(-1)
+        for b in gc._batches():
+            idx = np.unravel_index(np.arange(b.start, b.stop), shape[:2])
+            self._update(idx, cn[b], dens[b], in_area)
+        self.finalize()
+
+    def update_grid(self, rep_idx, t_idx, grid, in_area, cn=None):  # statistics of a single (rep, t) grid
+        cn = grid.cn if cn is None else cn
+        self._update((np.array([rep_idx]), np.array([t_idx])), cn.reshape(1, -1), grid.dens.reshape(1, -1),
+                     in_area.cell_list.reshape(-1))
+
+    def update_sparse_grid(self, rep_idx, t_idx, grid, in_area, in_area_count=None):
+        """ update_grid for a SparseVelocityGrid, in_area_count being the number of in_area cells """
+        in_area_count = np.count_nonzero(in_area.cell_list) if in_area_count is None else in_area_count
+        idx = (np.array([rep_idx]), np.array([t_idx]))
+        n = grid.num_tiles
+        x_idx, y_idx = grid.cells(np.arange(n))
+        inside = (x_idx < grid.x_size) & (y_idx < grid.y_size)
+        area = inside & in_area.cell_list[np.minimum(x_idx, grid.x_size - 1), np.minimum(y_idx, grid.y_size - 1)]
+        cn = grid.cn[:n].reshape(1, -1)
+        self.av_cn.dd.update(idx, cn, cn > 0)
+        self.max_cn.dd.av[idx] = cn.max(axis=-1, initial=0)
+        self.dens.dd.update(idx, grid.dens[:n][area].reshape(1, -1))
+        self.av_in_cn.dd.update(idx, grid.cn[:n][area].reshape(1, -1))
+        outside = StatsArray(1)  # in_area cells without a tile, where dens and cn are zero
+        outside.conta[...] = in_area_count - np.count_nonzero(area)
+        self.dens.dd.merge(outside, idx)
+        self.av_in_cn.dd.merge(outside, idx)
+
+    def _update(self, idx, cn, dens, in_area):
+        """ Statistics of the (rep, t) grids idx, cn and dens as (grids, cells) arrays, in_area as (cells,) """
+        self.av_cn.dd.update(idx, cn, cn > 0)
+        self.max_cn.dd.av[idx] = cn.max(axis=-1, initial=0)
+        self.dens.dd.update(idx, dens[:, in_area])
+        self.av_in_cn.dd.update(idx, cn[:, in_area])
+
+    def finalize(self):
+        self.dens.dd.finalize()
+        self.av_cn.dd.finalize()
+        self.av_in_cn.dd.finalize()
         self.dens.finalize()
         self.max_cn.finalize()
         self.av_cn.finalize()
-        self.av_in_cn.finalize()
\ No newline at end of file
+        self.av_in_cn.finalize()
+
+
+CNResult = collections.namedtuple('CNResult', ['cn', 'rot', 'rotval', 'dens', 'vx', 'vy', 'in_area', 'update_count',
+                                               'statistics'])
+CNResult.__doc__ = """ Result of calc_cn: the (R, T, X, Y) fields of every repetition and time bin, in_area (X, Y),
+    update_count the (R, T) frames of each bin and statistics the finalized Statistics, whose av_cn.d.av,
+    av_cn.d.er, ... are (T,) arrays """
+
+
+def calc_cn(time, rep, x, y, vx, vy, x_size, y_size, delta_x, delta_y, x_min, y_min, delta_t, cn_radius,
+            num_repetitions=None, num_timesteps=None, frames=None):
+    """ Congestion number of pedestrians held in arrays, without going through positions files
+
+        time, rep, x, y, vx, vy hold one entry per pedestrian and frame, rep may be None for a single
+        repetition. The grid parameters are those of a parameters file, in the order of
+        Params.grid_args, num_repetitions and num_timesteps default to the extent of rep and time.
+        The density of a bin is averaged over its frames, taken as the distinct (rep, time) of the
+        pedestrians unless frames = (frame_time, frame_rep) lists every frame, including those
+        without any pedestrian. The inputs are not copied when they already are float64 arrays.
+    """
+    time, x, y, vx, vy = (np.asarray(a, dtype=np.float64) for a in (time, x, y, vx, vy))
+    rep = np.zeros(time.shape, dtype=np.int64) if rep is None else np.asarray(rep, dtype=np.int64)
+    t_idx = (time / delta_t).astype(np.int64)
+    if num_repetitions is None:
+        num_repetitions = int(rep.max()) + 1 if rep.size else 1
+    if num_timesteps is None:
+        num_timesteps = int(t_idx.max()) + 1 if t_idx.size else 1
+    gc = GridCollection(num_repetitions, num_timesteps, x_size, y_size, delta_x, delta_y, x_min, y_min, delta_t)
+    if frames is None:
+        order = np.lexsort((time, rep))
+        frame_rep, frame_time = rep[order], time[order]
+        first = np.ones(order.size, dtype=bool)  # first pedestrian of each frame, -0.0 being the frame of 0.0
+        first[1:] = (frame_rep[1:] != frame_rep[:-1]) | (frame_time[1:] != frame_time[:-1])
+        frame_rep, frame_time = frame_rep[first], frame_time[first]
+    else:
+        frame_time = np.asarray(frames[0], dtype=np.float64)
+        frame_rep = (np.zeros(frame_time.shape, dtype=np.int64) if frames[1] is None
+                     else np.asarray(frames[1], dtype=np.int64))
+    frame_t_idx = (frame_time / delta_t).astype(np.int64)
+    valid = ((frame_rep >= 0) & (frame_rep < num_repetitions) & (frame_t_idx >= 0) &
+             (frame_t_idx < num_timesteps))
+    np.add.at(gc.update_count, (frame_rep[valid], frame_t_idx[valid]), 1)
+    gc.add_pedestrians(rep, t_idx, x, y, vx, vy)
+    gc.scale_velocity_field()
+    gc.calc_rotor()
+    gc.calc_cn(cn_radius)
+    stats = Statistics(gc)
+    stats.calc_statistics()
+    return CNResult(gc.cn, gc.rot, gc.rotval, gc.dens, gc.vx, gc.vy, gc.in_area.cell_list, gc.update_count, stats)
@@ -0,0 +1,250 @@
+import collections
+import itertools
+import os
+import queue
+import threading
+
+import numpy as np
+
+
+FrameBlock = collections.namedtuple('FrameBlock', ['times', 'counts', 'x', 'y', 'vx', 'vy'])
+FrameBlock.__doc__ = """ Consecutive frames of a positions file: per-frame times and pedestrian counts, and the
+    x, y, vx, vy of all their pedestrians concatenated in file order """
+
+
+def read_frame_blocks(fname, block_frames=4096):
+    """ Parses a positions file into FrameBlocks of up to block_frames frames
+
+        Each frame is a "time count" line followed by one line of count * 4 values, so a block is
+        parsed with two numpy calls instead of a float() per token.
+    """
+    with open(fname) as fp:
+        while True:
+            lines = list(itertools.islice(fp, 2 * block_frames))
+            if not lines:
+                return
+            if len(lines) % 2:  # last frame without its (empty) pedestrian line
+                lines.append('')
+            header = np.fromstring(' '.join(lines[0::2]), dtype=np.float64, sep=' ').reshape(-1, 2)
+            counts = header[:, 1].astype(np.int64)
+            values = ' '.join(lines[1::2])
+            values = np.fromstring(values, dtype=np.float64, sep=' ') if values.strip() else np.zeros(0)
+            if values.size != 4 * counts.sum():
+                raise ValueError(f"{fname}: expected {4 * counts.sum()} pedestrian values, found {values.size}")
+            values = values.reshape(-1, 4)
+            yield FrameBlock(header[:, 0], counts, values[:, 0], values[:, 1], values[:, 2], values[:, 3])
+
+
+def prefetched(iterable, depth=2):
+    """ Iterates iterable in a background thread, which runs up to depth items ahead of the consumer
+
+        The thread blocks while depth items are waiting, so reading overlaps with the processing of
+        the previous items in bounded memory. Errors of iterable are raised to the consumer, closing
+        the generator stops the thread.
+    """
+    items = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+    done = object()
+
+    def put(item):  # False once the consumer is gone
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put((item, None)):
+                    return
+        except BaseException as e:
+            put((done, e))
+        else:
+            put((done, None))
+
+    thread = threading.Thread(target=produce, name='pedtools-prefetch', daemon=True)
+    thread.start()
+    try:
+        while True:
+            item, error = items.get()
+            if item is done:
+                if error is not None:
+                    raise error
+                return
+            yield item
+    finally:
+        stop.set()
+        thread.join()
+
+
+POSITIONS_MAGIC = b'PEDPOS02'  # format version 02
+POSITIONS_HEADER = np.dtype([('magic', 'S8'), ('num_frames', '<u8'), ('num_records', '<u8'),
+                             ('source_size', '<u8'), ('source_mtime_ns', '<i8')])
+FRAME_INDEX = np.dtype([('time', '<f8'), ('offset', '<u8'), ('count', '<u8')])
+
+
+def write_binary_positions(fname, out_fname, block_frames=4096):
+    """ Converts the positions file fname into the indexed binary format, written to out_fname
+
+        The file is a header (magic, num_frames, num_records and the size and mtime of fname), the
+        pedestrians as num_records x 4 float32 (x, y, vx, vy) in file order, then the frame index of
+        num_frames (time, offset, count) entries, offset being the first record of the frame. Times stay
+        float64, so frames fall into the same time bins as with the text file. Returns the header.
+    """
+    source = os.stat(fname)  # before reading, a file changed meanwhile no longer matches
+    times, counts = [], []
+    num_records = 0
+    tmp_fname = out_fname + '.tmp'
+    with open(tmp_fname, 'wb') as fp:
+        fp.write(bytes(POSITIONS_HEADER.itemsize))  # rewritten once the counts are known
+        for block in read_frame_blocks(fname, block_frames):
+            fp.write(np.stack((block.x, block.y, block.vx, block.vy), axis=-1).astype('<f4').tobytes())
+            times.append(block.times)
+            counts.append(block.counts)
+            num_records += int(block.counts.sum())
+        index = np.zeros(sum(t.size for t in times), dtype=FRAME_INDEX)
+        if index.size:
+            index['time'] = np.concatenate(times)
+            index['count'] = np.concatenate(counts)
+            index['offset'] = np.cumsum(index['count']) - index['count']
+        fp.write(index.tobytes())
+        header = np.array((POSITIONS_MAGIC, index.size, num_records, source.st_size, source.st_mtime_ns),
+                          dtype=POSITIONS_HEADER)
+        fp.seek(0)
+        fp.write(header.tobytes())
+    os.replace(tmp_fname, out_fname)
+    return header
+
+
+def _binary_positions_header(fname):  # header of a binary positions file, None if it is not one
+    header = np.fromfile(fname, dtype=POSITIONS_HEADER, count=1)
+    if header.size == 0 or header['magic'][0] != POSITIONS_MAGIC:
+        return None
+    return header
+
+
+def read_binary_positions(fname):
+    """ (frame index, records) of an indexed binary positions file, both memory-mapped """
+    header = _binary_positions_header(fname)
+    if header is None:
+        raise ValueError(f"{fname}: not a binary positions file")
+    num_frames, num_records = int(header['num_frames'][0]), int(header['num_records'][0])
+    offset = POSITIONS_HEADER.itemsize
+    records = (np.memmap(fname, dtype='<f4', mode='r', offset=offset, shape=(num_records, 4)) if num_records
+               else np.zeros((0, 4), dtype='<f4'))
+    offset += records.nbytes
+    index = (np.memmap(fname, dtype=FRAME_INDEX, mode='r', offset=offset, shape=(num_frames,)) if num_frames
+             else np.zeros(0, dtype=FRAME_INDEX))
+    return index, records
+
+
+def _in_window(times, time_window):
+    t_start, t_end = time_window
+    keep = np.ones(times.shape, dtype=bool)
+    if t_start is not None:
+        keep &= times >= t_start
+    if t_end is not None:
+        keep &= times < t_end
+    return keep
+
+
+def read_binary_blocks(fname, block_frames=4096, time_window=None):
+    """ FrameBlocks of an indexed binary positions file, as read_frame_blocks
+
+        With time_window = (t_start, t_end), only the frames with t_start <= time < t_end are read,
+        either bound may be None. The frame index is scanned to find them, only their records are
+        read from the file.
+    """
+    index, records = read_binary_positions(fname)
+    if time_window is None:
+        frames = np.arange(index.size)
+    else:
+        frames = np.flatnonzero(_in_window(index['time'], time_window))
+    for start in range(0, frames.size, block_frames):
+        block_index = index[frames[start:start + block_frames]]
+        offsets, counts = block_index['offset'].astype(np.int64), block_index['count'].astype(np.int64)
+        if np.array_equal(offsets[1:], offsets[:-1] + counts[:-1]):  # consecutive frames, one slice
+            values = records[offsets[0]:offsets[-1] + counts[-1]]
+        else:
+            values = np.concatenate([records[o:o + c] for o, c in zip(offsets.tolist(), counts.tolist())])
+        values = np.asarray(values, dtype=np.float64)
+        yield FrameBlock(block_index['time'].copy(), counts, values[:, 0], values[:, 1], values[:, 2], values[:, 3])
+
+
+def _read_blocks(fname, block_frames=4096, time_window=None):  # FrameBlocks of a text or binary positions file
+    if fname.endswith('.bin'):
+        yield from read_binary_blocks(fname, block_frames, time_window)
+        return
+    for block in read_frame_blocks(fname, block_frames):
+        if time_window is not None:
+            keep = _in_window(block.times, time_window)
+            if not keep.any():
+                continue
+            ped_keep = np.repeat(keep, block.counts)
+            block = FrameBlock(block.times[keep], block.counts[keep], block.x[ped_keep], block.y[ped_keep],
+                               block.vx[ped_keep], block.vy[ped_keep])
+        yield block
+
+
+def positions_files(positions_dir, num_repetitions, binary=False):
+    """ pos_{rep}.dat of each repetition, or with binary its pos_{rep}.bin (see write_binary_positions)
+
+        The binary files hold float32 positions and velocities, so they are only read when asked for.
+        A pos_{rep}.bin that is missing, or whose recorded size and mtime no longer match pos_{rep}.dat,
+        i.e. converted before the text file last changed, is replaced by pos_{rep}.dat with a warning.
+    """
+    fnames = []
+    for rep_idx in range(num_repetitions):
+        dat_fname = os.path.join(positions_dir, f'pos_{rep_idx}.dat')
+        if not binary:
+            fnames.append(dat_fname)
+            continue
+        bin_fname = os.path.join(positions_dir, f'pos_{rep_idx}.bin')
+        if not os.path.exists(bin_fname):
+            print(f" No {bin_fname}, reading {dat_fname}: run convert_positions first")
+            bin_fname = dat_fname
+        elif os.path.exists(dat_fname):
+            header = _binary_positions_header(bin_fname)
+            source = os.stat(dat_fname)
+            if (header is None or int(header['source_size'][0]) != source.st_size or
+                    int(header['source_mtime_ns'][0]) != source.st_mtime_ns):
+                print(f" Ignoring {bin_fname}, out of date with {dat_fname}: convert it again")
+                bin_fname = dat_fname
+        fnames.append(bin_fname)
+    return fnames
+
+
+def read_positions(fnames, prefetch=0, block_frames=4096, time_window=None):
+    """ Yields (index in fnames, FrameBlock) for the positions files fnames in turn
+
+        Files ending in .bin are read as indexed binary files, others as text. With time_window =
+        (t_start, t_end), only the frames with t_start <= time < t_end are yielded. With prefetch > 0,
+        the files are read and parsed by a background thread up to prefetch blocks ahead, moving on to
+        the next file while the blocks of the current one are processed.
+    """
+    blocks = ((idx, block) for idx, fname in enumerate(fnames)
+              for block in _read_blocks(fname, block_frames, time_window))
+    return prefetched(blocks, prefetch) if prefetch > 0 else blocks
+
+
+def blocks_by_file(blocks, num_files):
+    """ Splits the (index, FrameBlock) of read_positions into one iterator of FrameBlocks per file, in order
+
+        Each iterator must be consumed before the next one is used, the blocks of a file left unread are
+        skipped. A file without any block gets an empty iterator.
+    """
+    blocks = iter(blocks)
+    pending = [next(blocks, None)]  # first item not yet handed out
+
+    def file_blocks(idx):
+        while pending[0] is not None and pending[0][0] < idx:
+            pending[0] = next(blocks, None)
+        while pending[0] is not None and pending[0][0] == idx:
+            yield pending[0][1]
+            pending[0] = next(blocks, None)
+
+    for idx in range(num_files):
+        yield file_blocks(idx)
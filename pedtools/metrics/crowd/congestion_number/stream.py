@@ -0,0 +1,121 @@
+import asyncio
+import concurrent.futures
+import sys
+
+import numpy as np
+
+from pedtools.metrics.crowd.congestion_number.congestion_number import OnlineGridCollection
+
+
+class _StdinReader:
+    """ readline of the standard input on a thread, which also works when stdin is a regular file """
+    def __init__(self, stream=None):
+        self.stream = sys.stdin.buffer if stream is None else stream
+
+    async def readline(self):
+        return await asyncio.get_running_loop().run_in_executor(None, self.stream.readline)
+
+
+async def read_frames_async(reader):
+    """ Yields (time, positions, velocities) for each frame read from reader, an asyncio.StreamReader
+
+        Same "time count" / "x y vx vy ..." line format as the positions files (see read_frame_blocks),
+        positions and velocities as (count, 2) arrays.
+    """
+    while True:
+        line = await reader.readline()
+        if not line:
+            return
+        if not line.strip():
+            continue
+        time, ped_count = line.split()
+        time = float(time)
+        ped_count = int(ped_count)
+        line = await reader.readline()
+        values = np.fromstring(line, dtype=np.float64, sep=' ') if line.strip() else np.zeros(0)
+        if values.size != 4 * ped_count:
+            raise ValueError(f"frame at time {time}: expected {4 * ped_count} pedestrian values, found {values.size}")
+        values = values.reshape(-1, 4)
+        yield time, values[:, :2], values[:, 2:]
+
+
+def format_bin(rep_idx, online_bin, delta_t):
+    """ One summary line per closed bin: rep, t_idx, bin centre, then av_cn, max_cn, av_in_cn and dens """
+    stats = online_bin.stats
+    values = ' '.join(f"{stats[name].av.item():.5f}" for name in ('av_cn', 'max_cn', 'av_in_cn', 'dens'))
+    return f"{rep_idx} {online_bin.t_idx} {online_bin.t_idx * delta_t + delta_t * 0.5:.5f} {values}\n"
+
+
+async def stream_cn(reader, online, write, queue_size=64, executor=None):
+    """ Feeds the frames of reader to online, calling write with the summary line of every closed bin
+
+        Parsing runs on the event loop and the CN on executor (a single thread by default, push is not
+        thread safe), connected by a queue of queue_size frames: reading goes on while a bin is being
+        computed, and a full queue stops reading from the source instead of buffering without bound.
+    """
+    loop = asyncio.get_running_loop()
+    own_executor = executor is None
+    if own_executor:
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+    frames = asyncio.Queue(maxsize=queue_size)
+
+    async def produce():
+        try:
+            async for frame in read_frames_async(reader):
+                await frames.put(frame)
+        finally:
+            await frames.put(None)  # end of feed
+
+    producer = asyncio.ensure_future(produce())
+    try:
+        while True:
+            frame = await frames.get()
+            if frame is None:
+                break
+            for online_bin in await loop.run_in_executor(executor, online.push, *frame):
+                write(format_bin(online.grid.rep_id, online_bin, online.delta_t))
+        await producer  # raises the parsing errors, if any
+        online_bin = await loop.run_in_executor(executor, online.flush)
+        if online_bin is not None:
+            write(format_bin(online.grid.rep_id, online_bin, online.delta_t))
+    finally:
+        producer.cancel()
+        if own_executor:
+            executor.shutdown(wait=False)
+
+
+def _write_stdout(line):
+    sys.stdout.write(line)
+    sys.stdout.flush()
+
+
+async def serve(source, grid_args, cn_radius, queue_size=64, write=_write_stdout):
+    """ Runs stream_cn on source: '-' for stdin, tcp://HOST:PORT or unix://PATH to listen for producers
+
+        grid_args are those of OnlineGridCollection up to delta_t. Each connection is a feed of its own,
+        numbered as a repetition in order of arrival. Stdin returns at its end, sockets serve until
+        cancelled.
+    """
+    if source == '-':
+        await stream_cn(_StdinReader(), OnlineGridCollection(*grid_args, cn_radius), write, queue_size)
+        return
+    connections = 0
+
+    async def handle(reader, writer):
+        nonlocal connections
+        rep_idx = connections
+        connections += 1
+        try:
+            await stream_cn(reader, OnlineGridCollection(*grid_args, cn_radius, rep_idx=rep_idx), write, queue_size)
+        finally:
+            writer.close()
+
+    if source.startswith('tcp://'):
+        host, port = source[len('tcp://'):].rsplit(':', 1)
+        server = await asyncio.start_server(handle, host, int(port))
+    elif source.startswith('unix://'):
+        server = await asyncio.start_unix_server(handle, source[len('unix://'):])
+    else:
+        raise ValueError(f"Unknown stream source: {source}, expected -, tcp://HOST:PORT or unix://PATH")
+    async with server:
+        await server.serve_forever()
@@ -30,5 +30,9 @@ setup(
     ],
     entry_points={"console_scripts": ["pedtools=pedtools.commands.main:main"],
                   "crowd": ["congestion_number = pedtools.metrics.crowd.congestion_number.congestion_number:calc_cn"],
+                  "pedtools": ["crowd = pedtools.metrics.crowd.command:crowd"],
+                  "pedtools.crowd": [
+                      "congestion_number = pedtools.metrics.crowd.congestion_number.command:congestion_number",
+                      "convert_positions = pedtools.metrics.crowd.congestion_number.command:convert_positions"],
                   },
 )
@@ -0,0 +1,28 @@
+import os
+import sys
+
+import pytest
+
+from pedtools.metrics.crowd.congestion_number.congestion_number import Params
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'benchmarks'))
+from generate import generate  # noqa: E402
+
+
+def write_study(directory, num_repetitions=3, num_timesteps=6, x_size=20, y_size=16, pedestrians=160, fps=4,
+                cn_radius=2.5, **kwargs):
+    """ The benchmarks/generate.py study at test sizes, returns its Params """
+    generate(directory, num_repetitions, num_timesteps, x_size, y_size, pedestrians, fps, cn_radius=cn_radius, **kwargs)
+    return Params(os.path.join(directory, 'parameters'))
+
+
+@pytest.fixture
+def make_study():
+    """ write_study, for tests writing a study of other sizes """
+    return write_study
+
+
+@pytest.fixture
+def study(tmp_path):
+    """ (directory, Params) of a small study written by write_study """
+    return str(tmp_path), write_study(str(tmp_path))
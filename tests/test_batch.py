@@ -0,0 +1,67 @@
+import json
+import os
+
+import pytest
+
+from pedtools.metrics.crowd.congestion_number import batch, cache
+from pedtools.metrics.crowd.congestion_number.cache import FieldCache, init_fields
+from pedtools.metrics.crowd.congestion_number.congestion_number import GridCollection
+
+
+def write_manifest(directory, settings):
+    fname = os.path.join(directory, 'manifest.yaml')
+    with open(fname, 'w') as fp:
+        fp.write(settings + 'cn_radius: 2.5\ndatasets:\n  - path: .\n')
+    return fname
+
+
+def test_flags_override_the_manifest(study, tmp_path, monkeypatch):
+    directory, params = study
+    fname = write_manifest(directory, f"workers: 2\nresults: {tmp_path / 'manifest_results.json'}\n")
+
+    def no_pool(*args, **kwargs):
+        raise AssertionError("the --workers flag asked for a single process")
+
+    monkeypatch.setattr(batch.concurrent.futures, 'ProcessPoolExecutor', no_pool)
+    content = batch.run_batch(fname, results=str(tmp_path / 'flag_results.json'), workers=1)
+    assert content['results'] == str(tmp_path / 'flag_results.json')
+    assert not os.path.exists(tmp_path / 'manifest_results.json')
+    with open(tmp_path / 'flag_results.json') as fp:
+        assert json.load(fp)['datasets'][0]['statistics'] == content['datasets'][0]['statistics']
+    assert 'error' not in content['datasets'][0]
+
+    with pytest.raises(AssertionError, match='single process'):  # without the flag, the manifest's 2 workers
+        batch.run_batch(fname)
+
+
+def fill_cache(directory, params, field_cache):
+    gc = GridCollection(*params.grid_args())
+    return gc, init_fields(gc, os.path.join(directory, 'positions'), field_cache)
+
+
+def test_cache_tolerates_concurrent_eviction(study, tmp_path, monkeypatch):
+    directory, params = study
+    field_cache = FieldCache(str(tmp_path / 'cache'))
+    gc, cached = fill_cache(directory, params, field_cache)
+    assert not cached
+
+    def evicted_meanwhile(path, *args, **kwargs):
+        raise FileNotFoundError(path)
+
+    monkeypatch.setattr(cache.os, 'utime', evicted_meanwhile)  # after the fields were read
+    loaded, cached = fill_cache(directory, params, field_cache)
+    assert cached and (loaded.rot == gc.rot).all()
+    monkeypatch.undo()
+
+    remove, listdir = os.remove, os.listdir
+
+    def removed_by_another_process(path):
+        remove(path)
+        remove(path)
+
+    monkeypatch.setattr(cache.os, 'remove', removed_by_another_process)
+    monkeypatch.setattr(cache.os, 'listdir', lambda path: listdir(path) + ['gone.npz'])
+    field_cache.max_bytes = 0
+    field_cache.evict()
+    monkeypatch.undo()
+    assert not [fname for fname in os.listdir(tmp_path / 'cache') if fname.endswith('.npz')]
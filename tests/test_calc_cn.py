@@ -0,0 +1,59 @@
+import os
+
+import numpy as np
+
+from pedtools.metrics.crowd.congestion_number.congestion_number import GridCollection, Statistics, calc_cn
+from pedtools.metrics.crowd.congestion_number.positions import read_frame_blocks
+
+
+def study_arrays(positions_dir, num_repetitions):
+    """ The pedestrians of the study as (time, rep, x, y, vx, vy) arrays, and its frames as (frame_time, frame_rep) """
+    peds, frames = [], []
+    for rep_idx in range(num_repetitions):
+        for block in read_frame_blocks(os.path.join(positions_dir, f'pos_{rep_idx}.dat')):
+            rep = np.full(block.times.shape, rep_idx)
+            peds.append((np.repeat(block.times, block.counts), np.repeat(rep, block.counts), block.x, block.y,
+                         block.vx, block.vy))
+            frames.append((block.times, rep))
+    return [np.concatenate(a) for a in zip(*peds)], [np.concatenate(a) for a in zip(*frames)]
+
+
+def test_calc_cn_matches_the_positions_files(study):
+    directory, params = study
+    positions = os.path.join(directory, 'positions')
+    gc = GridCollection(*params.grid_args())
+    gc.init_velocity_field(positions)
+    gc.scale_velocity_field()
+    gc.calc_rotor()
+    gc.calc_cn(2.5)
+    expected = Statistics(gc)
+    expected.calc_statistics()
+
+    num_repetitions, num_timesteps, *grid_args = params.grid_args()
+    (time, rep, x, y, vx, vy), frames = study_arrays(positions, num_repetitions)
+    for result in (calc_cn(time, rep, x, y, vx, vy, *grid_args, 2.5, frames=frames),
+                   calc_cn(time, rep, x, y, vx, vy, *grid_args, 2.5, num_repetitions, num_timesteps)):
+        assert np.count_nonzero(result.cn) > 0
+        np.testing.assert_array_equal(result.update_count, gc.update_count)
+        np.testing.assert_array_equal(result.in_area, gc.in_area.cell_list)
+        np.testing.assert_array_equal(result.cn, gc.cn)
+        for name in Statistics.FIELDS:
+            for field in ('av', 'er'):
+                np.testing.assert_array_equal(getattr(getattr(result.statistics, name).d, field),
+                                              getattr(getattr(expected, name).d, field))
+
+
+def test_calc_cn_frames():
+    # the frame at -0.0 is that at 0.0, the empty frame at 0.5 only counts when listed in frames
+    args = ([0.0, -0.0], None, [1.0, 2.0], [1.0, 1.0], [1.0, 1.0], [0.0, 0.0], 4, 4, 1.0, 1.0, 0, 0, 1.0, 2.5)
+    result = calc_cn(*args)
+    np.testing.assert_array_equal(result.update_count, [[1]])
+    assert result.dens[0, 0, 1, 1] == 1
+    result = calc_cn(*args, frames=([0.0, 0.5], None))
+    np.testing.assert_array_equal(result.update_count, [[2]])
+    assert result.dens[0, 0, 1, 1] == 0.5
+
+    result = calc_cn([], None, [], [], [], [], 4, 4, 1.0, 1.0, 0, 0, 1.0, 2.5)
+    assert result.cn.shape == (1, 1, 4, 4) and not result.cn.any() and not result.in_area.any()
+    np.testing.assert_array_equal(result.update_count, [[0]])
+    np.testing.assert_array_equal(result.statistics.av_cn.d.av, [0])
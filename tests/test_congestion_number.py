@@ -0,0 +1,173 @@
+import os
+
+import numpy as np
+import pytest
+
+from pedtools.metrics.crowd.congestion_number.congestion_number import (GridCollection, Statistics,
+                                                                        StreamingGridCollection, VelocityGrid,
+                                                                        calc_cn_field, calc_cn_field_adaptive,
+                                                                        calc_cn_field_tiled, calc_cn_sweep_field,
+                                                                        calc_rotor_field, calc_rotor_field_tiled,
+                                                                        load_fields)
+
+
+def random_grid(seed, x_size=23, y_size=17, delta_x=0.5):
+    """ VelocityGrid with a scaled random velocity field on about 70% of the cells and its rotor """
+    rng = np.random.default_rng(seed)
+    grid = VelocityGrid(0, x_size, y_size, delta_x, delta_x)
+    occupied = rng.random((x_size, y_size)) < 0.7
+    grid.dens[...] = occupied * rng.uniform(0.1, 2, (x_size, y_size))
+    grid.vx[...] = occupied * rng.normal(1, 0.5, (x_size, y_size))
+    grid.vy[...] = occupied * rng.normal(0, 0.5, (x_size, y_size))
+    grid.calc_rotor()
+    return grid
+
+
+@pytest.mark.parametrize('cn_radius', [1, 2, 3, 1.5, 2.5, 3.5])
+@pytest.mark.parametrize('seed', range(3))
+def test_vectorized_cn_matches_loop(seed, cn_radius):
+    grid = random_grid(seed)
+    assert grid.rotval.any()
+    grid.calc_cn(cn_radius, engine='loop')
+    loop_cn = grid.cn.copy()
+    grid.cn[...] = 0
+    grid.calc_cn(cn_radius, engine='vectorized')
+    assert np.count_nonzero(loop_cn) > 0
+    np.testing.assert_allclose(grid.cn, loop_cn, rtol=1e-13, atol=0)
+
+
+def test_unknown_cn_engine():
+    with pytest.raises(ValueError):
+        random_grid(0).calc_cn(2.5, engine='unknown')
+
+
+def test_sweep_matches_each_radius():
+    grids = [random_grid(seed) for seed in range(2)]
+    vx, vy, rot, rotval = (np.stack([getattr(g, name) for g in grids]) for name in ('vx', 'vy', 'rot', 'rotval'))
+    radii = [2.5, 0, 1, 3.5, 2, 1.5, 2.0, 2.5, 4]
+    sweep = calc_cn_sweep_field(vx, vy, rot, rotval, radii, 0.5)
+    assert sorted(sweep) == [0, 1, 1.5, 2, 2.5, 3.5, 4]
+    for radius, cn in sweep.items():
+        expected = calc_cn_field(vx, vy, rot, rotval, radius, 0.5)
+        assert radius == 0 or np.count_nonzero(expected) > 0
+        np.testing.assert_allclose(cn, expected, rtol=1e-13, atol=0)
+
+
+def test_sweep_and_adaptive_use_storage(study, tmp_path):
+    directory, params = study
+    results = {}
+    for storage in (None, str(tmp_path / 'storage')):
+        gc = GridCollection(*params.grid_args(), storage=storage)
+        gc.init_velocity_field(os.path.join(directory, 'positions'))
+        gc.scale_velocity_field()
+        gc.calc_rotor()
+        sweep = gc.calc_cn_sweep([1.5, 2.5])
+        exact = gc.calc_cn_adaptive(2.5, 0.05, block=4)
+        results[storage] = sweep, exact, gc.cn.copy()
+    (sweep, exact, cn), (mapped_sweep, mapped_exact, mapped_cn) = results.values()
+    assert all(isinstance(a, np.memmap) for a in list(mapped_sweep.values()) + [mapped_exact])
+    assert sorted(os.listdir(tmp_path / 'storage')) == sorted(
+        ['grid.json', 'in_area.npy', 'update_count.npy', 'cn_exact.npy', 'cn_r_1.5.npy', 'cn_r_2.5.npy'] +
+        [f'{name}.npy' for name, _ in VelocityGrid.FIELDS])
+    for radius in (1.5, 2.5):
+        np.testing.assert_array_equal(mapped_sweep[radius], sweep[radius])
+    np.testing.assert_array_equal(mapped_exact, exact)
+    np.testing.assert_array_equal(mapped_cn, cn)
+
+
+@pytest.mark.parametrize('compress', [True, False])
+def test_write_fields_round_trip(study, tmp_path, compress):
+    directory, params = study
+    gc = GridCollection(*params.grid_args(), time_window=(2, None))
+    gc.init_velocity_field(os.path.join(directory, 'positions'))
+    gc.scale_velocity_field()
+    gc.calc_rotor()
+    exact = gc.calc_cn_adaptive(2.5, 0.5, block=4)
+    assert gc.t_first == 2 and exact.any() and not exact.all()
+    fname = str(tmp_path / 'fields.npz')
+    gc.write_fields(fname, compress=compress, cn_exact=exact)
+    fields = load_fields(fname)
+    assert sorted(fields.files) == sorted(['v', 'rot', 'rotval', 'cn', 'dens', 'cn_exact', 'in_area', 'x_min',
+                                           'y_min', 'delta_x', 'delta_y', 'delta_t', 't_first'])
+    np.testing.assert_array_equal(fields['v'], np.stack((gc.vx, gc.vy), axis=-1))
+    for name in ('rot', 'rotval', 'cn', 'dens'):
+        assert fields[name].dtype == getattr(gc, name).dtype
+        np.testing.assert_array_equal(fields[name], getattr(gc, name))
+    np.testing.assert_array_equal(fields['cn_exact'], exact)
+    np.testing.assert_array_equal(fields['in_area'], gc.in_area.cell_list)
+    assert fields['t_first'] == 2 and fields['delta_t'] == gc.delta_t and fields['x_min'] == gc.in_area.x_min
+
+    gc.write_fields(fname, compress=compress)
+    assert 'cn_exact' not in load_fields(fname).files
+
+
+@pytest.mark.parametrize('tile', [3, 5, 7, 64])  # none divides the 23 x 17 grid
+@pytest.mark.parametrize('cn_radius', [1, 2.5, 6.5])  # halo ceil(cn_radius) + 1 up to 8, beyond tiles of 3 to 7
+def test_tiled_matches_untiled(tile, cn_radius):
+    grids = [random_grid(seed) for seed in range(2)]
+    vx, vy, dens = (np.stack([getattr(g, name) for g in grids]) for name in ('vx', 'vy', 'dens'))
+    rot, rotval = np.zeros(vx.shape), np.zeros(vx.shape, dtype=bool)
+    calc_rotor_field(vx, vy, dens, rot, rotval, 0.5)
+    tiled_rot, tiled_rotval = np.zeros(vx.shape), np.zeros(vx.shape, dtype=bool)
+    calc_rotor_field_tiled(vx, vy, dens, tiled_rot, tiled_rotval, 0.5, tile, workers=2)
+    np.testing.assert_array_equal(tiled_rotval, rotval)
+    np.testing.assert_array_equal(tiled_rot, rot)
+    cn = calc_cn_field(vx, vy, rot, rotval, cn_radius, 0.5)
+    assert np.count_nonzero(cn) > 0
+    np.testing.assert_array_equal(calc_cn_field_tiled(vx, vy, rot, rotval, cn_radius, 0.5, tile, workers=2), cn)
+
+    grid = grids[0]
+    grid.calc_cn(cn_radius)
+    untiled = grid.cn.copy()
+    grid.rot[...], grid.rotval[...], grid.cn[...] = 0, False, 0
+    grid.calc_rotor(tile=tile, workers=2)
+    grid.calc_cn(cn_radius, tile=tile, workers=2)
+    np.testing.assert_array_equal(grid.cn, untiled)
+
+
+def hotspot_fields(seed, x_size=23, y_size=17):
+    """ (vx, vy, rot, rotval) of two grids of a nearly uniform flow with a random vortex, its CN hotspot """
+    rng = np.random.default_rng(seed)
+    x, y = np.meshgrid(np.arange(x_size), np.arange(y_size), indexing='ij')
+    fields = []
+    for _ in range(2):
+        cx, cy = rng.uniform(0, x_size), rng.uniform(0, y_size)
+        swirl = 2 * np.exp(-((x - cx) ** 2 + (y - cy) ** 2) / 8)
+        vx = 1 + rng.normal(0, 0.01, x.shape) - swirl * (y - cy) / 3
+        vy = rng.normal(0, 0.01, x.shape) + swirl * (x - cx) / 3
+        dens = np.ones(x.shape)
+        rot, rotval = np.zeros(x.shape), np.zeros(x.shape, dtype=bool)
+        calc_rotor_field(vx, vy, dens, rot, rotval, 0.5)
+        fields.append((vx, vy, rot, rotval))
+    return [np.stack(a) for a in zip(*fields)]
+
+
+@pytest.mark.parametrize('block', [2, 3, 5, 8])  # none divides the 23 x 17 grid
+@pytest.mark.parametrize('cn_radius', [1, 2.5])
+@pytest.mark.parametrize('seed', range(2))
+def test_adaptive_cn_refines_every_cell_above_threshold(seed, cn_radius, block):
+    vx, vy, rot, rotval = hotspot_fields(seed)
+    exact_cn = calc_cn_field(vx, vy, rot, rotval, cn_radius, 0.5)
+    threshold = exact_cn.max() / 4
+    cn, exact = calc_cn_field_adaptive(vx, vy, rot, rotval, cn_radius, 0.5, threshold, block)
+    assert exact.any() and not exact.all()
+    np.testing.assert_array_equal(cn[exact], exact_cn[exact])
+    assert (cn[~exact] >= exact_cn[~exact]).all()
+    assert (cn[~exact] <= threshold).all()  # the bound of every block left unrefined
+    assert exact[exact_cn > threshold].all()
+
+
+@pytest.mark.parametrize('tile', [None, 4])
+def test_streaming_workers_match_single_process(study, tile):
+    directory, params = study
+    positions = os.path.join(directory, 'positions')
+    expected = StreamingGridCollection(*params.grid_args(), tile=tile).run(2.5, positions)
+    sgc = StreamingGridCollection(*params.grid_args(), tile=tile)
+    stats = sgc.run(2.5, positions, workers=2)
+    assert sgc.in_area.cell_list.any()
+    for name in Statistics.FIELDS:
+        distr, expected_distr = getattr(stats, name), getattr(expected, name)
+        assert expected_distr.d.av.any()
+        for field in ('conta', 'av', 'sg', 'er'):
+            np.testing.assert_array_equal(getattr(distr.dd, field), getattr(expected_distr.dd, field))
+            np.testing.assert_array_equal(getattr(distr.d, field), getattr(expected_distr.d, field))
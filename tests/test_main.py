@@ -0,0 +1,43 @@
+import os
+import sys
+
+from pedtools.commands import main
+
+
+def write_entry_points(site, content):
+    egg_info = os.path.join(site, 'demo.egg-info')
+    os.makedirs(egg_info, exist_ok=True)
+    with open(os.path.join(egg_info, 'entry_points.txt'), 'w') as fp:
+        fp.write(content)
+
+
+def test_entry_points_cache_follows_in_place_rewrites(tmp_path, monkeypatch):
+    site = str(tmp_path / 'site')
+    monkeypatch.setenv('PEDTOOLS_CACHE_DIR', str(tmp_path / 'cache'))
+    monkeypatch.setattr(sys, 'path', [str(tmp_path / 'script'), site])
+    os.makedirs(tmp_path / 'script')
+    write_entry_points(site, '[pedtools]\ncrowd = demo.command:crowd\n')
+    assert main.get_entry_points() == {'pedtools': {'crowd': 'demo.command:crowd'}}
+
+    discover = main._discover_entry_points
+    monkeypatch.setattr(main, '_discover_entry_points', None)  # served from the cache
+    assert main.get_entry_points() == {'pedtools': {'crowd': 'demo.command:crowd'}}
+    monkeypatch.setattr(main, '_discover_entry_points', discover)
+
+    # a develop install rewrites entry_points.txt in place, the sys.path directories keep their mtime
+    stamps = {path: os.stat(path).st_mtime_ns for path in sys.path}
+    write_entry_points(site, '[pedtools]\ncrowd = demo.command:crowd\n\n'
+                             '[pedtools.crowd]\nconvert_positions = demo.command:convert_positions\n')
+    for path, mtime_ns in stamps.items():
+        os.utime(path, ns=(mtime_ns, mtime_ns))
+    assert main.get_entry_points() == {'pedtools': {'crowd': 'demo.command:crowd'},
+                                       'pedtools.crowd': {'convert_positions': 'demo.command:convert_positions'}}
+
+
+def test_fingerprint_includes_the_first_sys_path_entry(tmp_path, monkeypatch):
+    for name in ('a', 'b', 'site'):
+        os.makedirs(tmp_path / name)
+    monkeypatch.setattr(sys, 'path', [str(tmp_path / 'a'), str(tmp_path / 'site')])
+    fingerprint = main._distributions_fingerprint([])
+    monkeypatch.setattr(sys, 'path', [str(tmp_path / 'b'), str(tmp_path / 'site')])
+    assert main._distributions_fingerprint([]) != fingerprint
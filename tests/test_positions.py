@@ -0,0 +1,87 @@
+import os
+
+import numpy as np
+import pytest
+
+from pedtools.metrics.crowd.congestion_number import congestion_number
+from pedtools.metrics.crowd.congestion_number.congestion_number import (GridCollection, Statistics,
+                                                                        StreamingGridCollection, window_bins)
+from pedtools.metrics.crowd.congestion_number.positions import blocks_by_file, positions_files, write_binary_positions
+
+
+def convert(positions_dir, num_repetitions):
+    for rep_idx in range(num_repetitions):
+        write_binary_positions(os.path.join(positions_dir, f'pos_{rep_idx}.dat'),
+                               os.path.join(positions_dir, f'pos_{rep_idx}.bin'))
+
+
+@pytest.mark.parametrize('time_window, expected', [
+    (None, (0, 6)), ((2, 4), (2, 2)), ((1.5, 3.2), (1, 3)), ((-np.inf, 2), (0, 2)), ((4, np.inf), (4, 2)),
+    ((None, 1), (0, 1)), ((7, 9), (6, 0))])
+def test_window_bins(time_window, expected):
+    assert window_bins(6, 1.0, time_window) == expected
+
+
+def test_binary_positions_only_when_asked(study):
+    directory, params = study
+    positions = os.path.join(directory, 'positions')
+    convert(positions, 3)
+    assert all(fname.endswith('.dat') for fname in positions_files(positions, 3))
+    assert all(fname.endswith('.bin') for fname in positions_files(positions, 3, binary=True))
+
+
+@pytest.mark.parametrize('binary', [False, True])
+def test_time_window_computes_only_its_bins(study, monkeypatch, binary):
+    directory, params = study
+    positions = os.path.join(directory, 'positions')
+    if binary:
+        convert(positions, 3)
+    full = GridCollection(*params.grid_args())
+    full.init_velocity_field(positions, binary=binary)
+    full.scale_velocity_field()
+    full.calc_rotor()
+    full.calc_cn(2.5)
+
+    gc = GridCollection(*params.grid_args(), time_window=(2, 4))
+    gc.init_velocity_field(positions, binary=binary)
+    gc.scale_velocity_field()
+    gc.calc_rotor()
+    gc.calc_cn(2.5)
+    assert gc.cn.shape == (3, 2, 20, 16)
+    np.testing.assert_array_equal(gc.update_count, full.update_count[:, 2:4])
+    np.testing.assert_array_equal(gc.cn, full.cn[:, 2:4])
+
+    calls = []
+    calc_cn_field = congestion_number.calc_cn_field
+    monkeypatch.setattr(congestion_number, 'calc_cn_field', lambda *args: calls.append(1) or calc_cn_field(*args))
+    stats = StreamingGridCollection(*params.grid_args(), time_window=(2, 4)).run(2.5, positions, binary=binary)
+    assert len(calls) == 3 * 2
+    windowed = Statistics(gc)
+    windowed.calc_statistics()
+    for name in Statistics.FIELDS:
+        np.testing.assert_allclose(getattr(stats, name).dd.av, getattr(windowed, name).dd.av, rtol=1e-12)
+    full_stats = Statistics(full)
+    full_stats.calc_statistics()
+    for name in ('av_cn', 'max_cn'):  # independent of in_area, the cells occupied within the window
+        np.testing.assert_allclose(getattr(stats, name).dd.av, getattr(full_stats, name).dd.av[:, 2:4], rtol=1e-12)
+    assert [round(t, 5) for t in stats.to_dict()['av_cn']['time']] == [2.5, 3.5]
+
+
+def test_blocks_by_file():
+    blocks = [(0, 'a0'), (0, 'a1'), (2, 'c0'), (3, 'd0'), (3, 'd1')]
+    files = list(blocks_by_file(blocks, 5))  # the iterators are only read when consumed
+    assert [list(f) for f in files] == [['a0', 'a1'], [], ['c0'], ['d0', 'd1'], []]
+    files = blocks_by_file(blocks, 4)
+    assert next(next(files)) == 'a0'  # a1 left unread
+    assert [list(f) for f in files] == [[], ['c0'], ['d0', 'd1']]
+
+
+def test_streaming_prefetch_across_files(study):
+    directory, params = study
+    positions = os.path.join(directory, 'positions')
+    open(os.path.join(positions, 'pos_1.dat'), 'w').close()  # a repetition without frames
+    expected = StreamingGridCollection(*params.grid_args()).run(2.5, positions)
+    stats = StreamingGridCollection(*params.grid_args(), prefetch=2).run(2.5, positions)
+    for name in Statistics.FIELDS:
+        np.testing.assert_array_equal(getattr(stats, name).dd.av, getattr(expected, name).dd.av)
+    assert not stats.max_cn.dd.av[1].any() and stats.max_cn.dd.av[[0, 2]].all()
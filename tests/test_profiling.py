@@ -0,0 +1,66 @@
+import json
+import os
+import tracemalloc
+
+import pluggy  # type: ignore
+import pytest
+
+from pedtools.commands.action import PedtoolsAction
+from pedtools.commands.hookspecs import PedtoolsPlugin
+from pedtools.commands.profiling import ProfilingPlugin
+from pedtools.metrics.crowd.congestion_number.command import CongestionNumberCommand
+
+
+class FailingAction(PedtoolsAction):
+    def help_description(self):
+        return "Fails in its second stage"
+
+    def action(self, config: dict):
+        with self.stage(config, 'ingest') as record:
+            record['items'] = 3
+        with self.stage(config, 'cn') as record:
+            record['items'] = 1
+            raise ValueError("broken input")
+
+
+def profiled(action, fname):
+    pm = pluggy.PluginManager("pedtools")
+    pm.add_hookspecs(PedtoolsPlugin)
+    pm.register(ProfilingPlugin(fname), 'profiling')
+    action.add_hook(pm.hook)
+    return action
+
+
+def test_profile_of_a_failed_action(tmp_path):
+    action = profiled(FailingAction(), str(tmp_path / 'profile.json'))
+    assert not tracemalloc.is_tracing()
+    with pytest.raises(ValueError, match='broken input'):
+        action.run_action({'namespace': 'pedtools.test'})
+    assert not tracemalloc.is_tracing()
+    with open(tmp_path / 'profile.json') as fp:
+        report = json.load(fp)
+    assert report['command'] == 'pedtools.test'
+    assert [(stage['stage'], stage['items']) for stage in report['stages']] == [('ingest', 3), ('cn', 1)]
+    assert all(stage['memory_delta'] is not None for stage in report['stages'])
+
+
+@pytest.mark.parametrize('workers', [1, 2])
+def test_profile_of_a_streaming_run(study, tmp_path, workers):
+    directory, params = study
+    action = profiled(CongestionNumberCommand(), str(tmp_path / 'profile.json'))
+    _, config = action.get_config_parameters()
+    config.update(namespace='pedtools.crowd.congestion_number', parameters=os.path.join(directory, 'parameters'),
+                  positions=os.path.join(directory, 'positions'), output=str(tmp_path / 'out'), streaming=True,
+                  workers=workers)
+    action.run_action(config)
+    with open(tmp_path / 'profile.json') as fp:
+        stages = {stage['stage']: stage for stage in json.load(fp)['stages']}
+    num_grids = params.grid_args()[0] * params.grid_args()[1]
+    assert list(stages) == ['stream', 'ingest', 'scale', 'rotor', 'cn', 'statistics', 'write']
+    assert stages['ingest']['items'] == num_grids * 4  # frames, 4 per time bin
+    for name in ('stream', 'scale', 'rotor', 'cn', 'statistics'):
+        assert stages[name]['items'] == num_grids
+    for name in ('ingest', 'scale', 'rotor', 'cn', 'statistics'):
+        assert stages[name]['elapsed'] > 0
+        assert stages[name]['memory_delta'] is None and stages[name]['memory_peak'] is None
+    assert stages['stream']['memory_peak'] is not None
@@ -0,0 +1,67 @@
+import numpy as np
+import pytest
+
+from pedtools.metrics.crowd.congestion_number.congestion_number import (BoolGrid, GridCollection, SparseVelocityGrid,
+                                                                        Statistics, VelocityGrid)
+
+
+def add_crowds(grids, rng, x_size, y_size, delta_x, batches=3):
+    """ Adds a few clusters of pedestrians to each of grids, in batches so the sparse tiles grow several times """
+    for _ in range(batches):
+        centre = rng.uniform((0, 0), (x_size * delta_x, y_size * delta_x))
+        pos = centre + rng.normal(0, 1.0, (int(rng.integers(50, 150)), 2))  # some land outside the grid
+        vel = rng.normal((1, 0), 0.5, pos.shape)
+        for grid in grids:
+            grid.add_pedestrians(pos[:, 0], pos[:, 1], vel[:, 0], vel[:, 1])
+    for grid in grids:
+        grid.update_count[...] = 3
+
+
+@pytest.mark.parametrize('tile', range(2, 9))  # none divides the 47 x 37 grid
+@pytest.mark.parametrize('cn_radius', [1, 2.5, 8.5])  # 8.5 gathers more than one ring of tiles, even of 8 cells
+@pytest.mark.parametrize('seed', range(2))
+def test_sparse_grid_matches_dense(seed, cn_radius, tile, capsys):
+    x_size, y_size, delta_x = 47, 37, 0.5
+    rng = np.random.default_rng(seed)
+    dense = VelocityGrid(0, x_size, y_size, delta_x, delta_x)
+    sparse = SparseVelocityGrid(0, x_size, y_size, delta_x, delta_x, tile=tile)
+    add_crowds([sparse], rng, x_size, y_size, delta_x)  # a previous time bin, cleared
+    sparse.scale_velocity_field(BoolGrid(x_size, y_size, delta_x, delta_x))
+    sparse.calc_rotor()
+    sparse.calc_cn(cn_radius)
+    sparse.clear()
+
+    add_crowds([dense, sparse], rng, x_size, y_size, delta_x)
+    capsys.readouterr()
+    assert 0 < sparse.num_tiles < sparse.tile_map.size
+    in_areas = []
+    for grid in (dense, sparse):
+        in_area = BoolGrid(x_size, y_size, delta_x, delta_x)
+        grid.scale_velocity_field(in_area)
+        grid.calc_rotor()
+        grid.calc_cn(cn_radius)
+        in_areas.append(in_area)
+    np.testing.assert_array_equal(in_areas[1].cell_list, in_areas[0].cell_list)
+    assert np.count_nonzero(dense.cn) > 0
+    result = sparse.to_dense()
+    for name, _ in VelocityGrid.FIELDS:
+        np.testing.assert_array_equal(getattr(result, name), getattr(dense, name))
+    assert result.update_count == dense.update_count
+
+    # in_area of the study also holds cells occupied in other time bins, outside the tiles of this one
+    in_area = in_areas[0]
+    in_area.cell_list |= rng.random((x_size, y_size)) < 0.2
+    gc = GridCollection(1, 1, x_size, y_size, delta_x, delta_x, 0, 0, 1.0)
+    expected, stats = Statistics(gc), Statistics(gc)
+    expected.update_grid(0, 0, dense, in_area)
+    stats.update_sparse_grid(0, 0, sparse, in_area)
+    for name in Statistics.FIELDS:
+        for field in ('conta', 'av', 'sg'):
+            np.testing.assert_allclose(getattr(getattr(stats, name).dd, field),
+                                       getattr(getattr(expected, name).dd, field), rtol=1e-12, atol=1e-15)
+
+
+@pytest.mark.parametrize('tile', [0, 1])
+def test_sparse_tile_must_hold_the_rotor_neighbours(tile):
+    with pytest.raises(ValueError, match='at least 2'):
+        SparseVelocityGrid(0, 10, 10, tile=tile)
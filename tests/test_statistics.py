@@ -0,0 +1,148 @@
+import math
+import os
+
+import numpy as np
+import pytest
+
+from pedtools.metrics.crowd.congestion_number.congestion_number import DDistr, GridCollection, Statistics, StatsArray
+
+
+class CellStats:
+    """ The per-cell StatsCell the array statistics replaced: sums of the values and of their squares """
+    def __init__(self):
+        self.conta = 0
+        self.av = 0
+        self.sg = 0
+        self.er = 0
+
+    def update(self, up):
+        self.av += up
+        self.sg += up * up
+        self.conta += 1
+
+    def finalize(self):
+        if self.conta:
+            self.av /= self.conta
+            self.sg /= self.conta
+        if self.conta > 1:
+            self.sg = np.sqrt(self.sg - self.av ** 2)
+            self.er = self.sg / np.sqrt(self.conta - 1)
+        else:
+            self.sg = 0
+            self.er = 0
+
+
+def cell_statistics(gc):
+    """ {name: (per-(rep, t) averages, per-t averages, per-t errors)} computed cell by cell """
+    result = {}
+    for name in Statistics.FIELDS:
+        dd = [[CellStats() for _ in range(gc.num_timesteps)] for _ in range(gc.num_repetitions)]
+        for rep_idx in range(gc.num_repetitions):
+            for t_idx in range(gc.num_timesteps):
+                grid = gc.grid_collection[rep_idx][t_idx]
+                cell = dd[rep_idx][t_idx]
+                for i in range(grid.x_size):
+                    for j in range(grid.y_size):
+                        cn = grid[i][j].cn
+                        if name == 'av_cn' and cn > 0:
+                            cell.update(cn)
+                        elif name == 'max_cn' and cn > cell.av:
+                            cell.av = cn
+                        elif name in ('dens', 'av_in_cn') and gc.in_area[i][j]:
+                            cell.update(grid[i][j].dens if name == 'dens' else cn)
+                if name != 'max_cn':
+                    cell.finalize()
+        d = [CellStats() for _ in range(gc.num_timesteps)]
+        for t_idx in range(gc.num_timesteps):
+            for rep_idx in range(gc.num_repetitions):
+                d[t_idx].update(dd[rep_idx][t_idx].av)
+            d[t_idx].finalize()
+        result[name] = (np.array([[cell.av for cell in row] for row in dd]), np.array([cell.av for cell in d]),
+                        np.array([cell.er for cell in d]))
+    return result
+
+
+def test_array_statistics_match_cell_statistics(study, tmp_path):
+    directory, params = study
+    gc = GridCollection(*params.grid_args())
+    gc.init_velocity_field(os.path.join(directory, 'positions'))
+    gc.scale_velocity_field()
+    gc.calc_rotor()
+    gc.calc_cn(2.5)
+    stats = Statistics(gc)
+    stats.calc_statistics()
+    expected = cell_statistics(gc)
+    for name in Statistics.FIELDS:
+        dd_av, d_av, d_er = expected[name]
+        assert d_av.any()
+        distr = getattr(stats, name)
+        np.testing.assert_allclose(distr.dd.av, dd_av, rtol=1e-12, atol=1e-15)
+        np.testing.assert_allclose(distr.d.av, d_av, rtol=1e-12, atol=1e-15)
+        np.testing.assert_allclose(distr.d.er, d_er, rtol=1e-6, atol=1e-12)  # sum of squares loses digits
+        with open(tmp_path / f'{name}.dat', 'w') as fp:
+            for t_idx in range(gc.num_timesteps):
+                time = t_idx * gc.delta_t + gc.delta_t * 0.5
+                fp.write(f"{time:.5f} {d_av[t_idx] - d_er[t_idx]:.5f} {d_av[t_idx]:.5f} "
+                         f"{d_av[t_idx] + d_er[t_idx]:.5f}\n")
+    out_dir = tmp_path / 'out'
+    out_dir.mkdir()
+    stats.write_to_files(str(out_dir))
+    for name in Statistics.FIELDS:
+        assert (out_dir / f'{name}.dat').read_text() == (tmp_path / f'{name}.dat').read_text()
+
+
+def test_variance_of_equal_values_is_not_negative():
+    values = [0.1, 0.1, 0.1]  # the sums of the values and of their squares give a variance of -1.7e-18
+    mean = sum(values) / 3
+    with pytest.raises(ValueError, match='math domain error'):
+        math.sqrt(sum(v * v for v in values) / 3 - mean ** 2)
+    stats = StatsArray(2)
+    stats.update(0, np.array(values))
+    for value in values:
+        stats.update(1, np.array([value]))
+    assert (stats.sg >= 0).all()
+    stats.finalize()
+    np.testing.assert_allclose(stats.sg, 0, atol=1e-15)
+    np.testing.assert_allclose(stats.er, 0, atol=1e-15)
+    distr = DDistr(1, 1, 1.0)
+    for value in values:
+        distr.update(value, 0, 0.5)
+    distr.dd.finalize()
+    assert 0 <= distr.dd.sg[0, 0] < 1e-15
+
+
+def test_windowed_distribution_bins_by_study_time(tmp_path):
+    distr = DDistr(2, 2, 0.5, t_first=4)  # the bins of 2.0 <= t < 3.0
+    distr.update(1.0, 0, 2.1)
+    distr.update(3.0, 0, 2.4)
+    distr.update(5.0, 1, 2.9)
+    np.testing.assert_array_equal(distr.dd.conta, [[2, 0], [0, 1]])
+    np.testing.assert_array_equal(distr.dd.av, [[2, 0], [0, 5]])
+    with pytest.raises(IndexError):
+        distr.update(1.0, 0, 3.0)
+    distr.finalize()
+    distr.write_to_file(str(tmp_path / 'distr.dat'))
+    times = [line.split()[0] for line in (tmp_path / 'distr.dat').read_text().splitlines()]
+    assert times == ['2.25000', '2.75000']
+
+
+def test_merge_equals_single_pass():
+    rng = np.random.default_rng(0)
+    values = rng.normal(1e6, 1, (4, 30))  # a large mean, where the sums of squares cancel badly
+    mask = rng.random(values.shape) < 0.7
+    single = StatsArray(4)
+    single.update(Ellipsis, values, mask)
+    merged = StatsArray(4)
+    for chunk in np.array_split(np.arange(30), [1, 12, 13]):
+        part = StatsArray(4)
+        part.update(Ellipsis, values[:, chunk], mask[:, chunk])
+        merged.merge(part)
+    np.testing.assert_array_equal(merged.conta, mask.sum(axis=1))
+    np.testing.assert_allclose(merged.av, single.av, rtol=1e-15)
+    np.testing.assert_allclose(merged.sg, single.sg, rtol=1e-9)
+    single.finalize()
+    merged.finalize()
+    for mean, std, row, row_mask in zip(merged.av, merged.sg, values, mask):
+        assert mean == pytest.approx(row[row_mask].mean(), rel=1e-15)
+        assert std == pytest.approx(row[row_mask].std(), rel=1e-9)
+    np.testing.assert_allclose(merged.er, single.er, rtol=1e-9)
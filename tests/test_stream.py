@@ -0,0 +1,48 @@
+import asyncio
+import os
+
+import numpy as np
+
+from pedtools.metrics.crowd.congestion_number.congestion_number import (OnlineGridCollection,
+                                                                        StreamingGridCollection)
+from pedtools.metrics.crowd.congestion_number.stream import stream_cn
+
+
+def feed(data, grid_args, cn_radius):
+    """ Summary lines of stream_cn on a StreamReader fed with data, as a local producer would """
+    async def run():
+        reader = asyncio.StreamReader()
+        reader.feed_data(data)
+        reader.feed_eof()
+        lines = []
+        await stream_cn(reader, OnlineGridCollection(*grid_args, cn_radius), lines.append, queue_size=4)
+        return lines
+
+    return asyncio.run(run())
+
+
+def test_stream_matches_batch(tmp_path, capsys, make_study):
+    params = make_study(str(tmp_path), num_repetitions=1)
+    fname = os.path.join(str(tmp_path), 'positions', 'pos_0.dat')
+    with open(fname) as fp:
+        lines = fp.readlines()
+    lines[1] = '-5.0 ' + lines[1].split(' ', 1)[1]  # a pedestrian outside the grid
+    with open(fname, 'w') as fp:
+        fp.writelines(lines)
+    stats = StreamingGridCollection(*params.grid_args()).run(2.5, os.path.join(str(tmp_path), 'positions'))
+    capsys.readouterr()
+
+    summaries = feed(''.join(lines).encode(), params.grid_args()[2:], 2.5)
+    out, err = capsys.readouterr()
+    assert out == ''  # the diagnostics do not mix with the summaries
+    assert ' Ignoring pedestrian at x: -5.0' in err
+    assert len(summaries) == params.grid_args()[1]
+    rows = np.array([[float(v) for v in line.split()] for line in summaries])
+    np.testing.assert_array_equal(rows[:, :2], [[0, t_idx] for t_idx in range(len(summaries))])
+    np.testing.assert_allclose(rows[:, 2], np.arange(len(summaries)) + 0.5)
+    # av_in_cn and dens are averaged over the cells seen so far, the whole study's by the last bin
+    for column, name in enumerate(('av_cn', 'max_cn')):
+        expected = [f'{v:.5f}' for v in getattr(stats, name).dd.av[0].tolist()]
+        assert [line.split()[3 + column] for line in summaries] == expected
+    expected = [f'{getattr(stats, name).dd.av[0, -1].item():.5f}' for name in ('av_cn', 'max_cn', 'av_in_cn', 'dens')]
+    assert summaries[-1].split()[3:] == expected